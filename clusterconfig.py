@@ -5,10 +5,22 @@ import re
 import csv
 import sys
 import json
+import time
+import queue
 import socket
+import zlib
+import codecs
+import atexit
+import signal
+import struct
+import sqlite3
+import hashlib
+import weakref
+import threading
 import requests
 import paramiko
 import subprocess
+import concurrent.futures
 from pprint import pprint
 from urllib.parse import quote
 
@@ -19,9 +31,58 @@ DIR="/root/source/export-import/output"
 
 # Maximum number of jobs you can run on a CVM. This is used by the export script and the
 # import SFTP script to regulate qemu-img convert jobs on the CVM.
-# No real reason to change this unless your CVMs are too busy.
+# No real reason to change this unless your CVMs are too busy. sshd on the CVMs only lets us run 8
+# at a time (see SSH_MAX_SESSIONS), so anything above that counts as 8.
 MAX_CVM_JOBS=6
 
+# Enabled by default. Every 30 seconds the scripts look at how busy each CVM is: its load average
+# per core, how much CPU the hypervisor steals from it, and how long its disks take to answer. A CVM
+# that is over any of CVM_BUSY_LOAD, CVM_BUSY_STEAL (%) or CVM_BUSY_LATENCY (ms) gets half as many
+# conversion jobs, but never fewer than MIN_CVM_JOBS. A quiet CVM gets one more, up to MAX_CVM_JOBS.
+# Running jobs are never stopped, a busy CVM just doesn't get new ones until it has fewer.
+# Disabled, every CVM runs MAX_CVM_JOBS jobs.
+ADAPTIVE_CVM_JOBS=True
+#ADAPTIVE_CVM_JOBS=False
+MIN_CVM_JOBS=1
+CVM_BUSY_LOAD=1.5
+CVM_BUSY_STEAL=10
+CVM_BUSY_LATENCY=25
+
+# Number of qcow2 files the export script downloads, and the import script uploads, at the same
+# time. Leave this at 1 if your removeable drive is a slow HDD. A fast SSD removeable drive can
+# easily keep up with 4 or more. Can be overridden on the command line with --streams.
+# Only used with ADAPTIVE_TRANSFERS disabled.
+MAX_TRANSFERS=1
+
+# Enabled by default. The scripts measure how fast the removeable drive in DIR writes, reads and
+# syncs when they start, and then keep raising or lowering the number of files they transfer at the
+# same time, depending on how fast the transfers go. This is never more than MAX_ADAPTIVE_TRANSFERS,
+# or more than the drive can keep up with. --streams N turns this off and moves N files at a time.
+ADAPTIVE_TRANSFERS=True
+#ADAPTIVE_TRANSFERS=False
+MAX_ADAPTIVE_TRANSFERS=8
+
+# With --qemu, the export script starts downloading each qcow2 file as soon as it is converted.
+# This is the most files that can be converted (or converting) but not yet downloaded at any time.
+# It keeps the CVMs from getting too far ahead of the downloads, and limits how much space
+# EXPORTCONTAINER needs, especially with REMOVE_AFTER_DOWNLOAD.
+MAX_PENDING_DOWNLOADS=8
+
+# Set to True to remove each qcow2 file from EXPORTCONTAINER once it has been downloaded.
+REMOVE_AFTER_DOWNLOAD=False
+#REMOVE_AFTER_DOWNLOAD=True
+
+# Enabled by default. With --qemu, every qcow2 file converted into EXPORTCONTAINER gets a record next
+# to it (<file>.qcow2.cache) with the vdisk it came from, the vm_logical_timestamp of its VM, the size
+# of the vdisk and the qemu-img options. A later --qemu run downloads a file whose record still
+# matches as it is, instead of converting the vdisk again. The cached files of VMs that are not part
+# of an export are removed, least recently used first, when EXPORTCONTAINER doesn't have room for the
+# export, or when the cached files take up more than CACHE_MAX_GB. 0 means only the room left in
+# EXPORTCONTAINER counts. Has no effect with REMOVE_AFTER_DOWNLOAD.
+CONVERSION_CACHE=True
+#CONVERSION_CACHE=False
+CACHE_MAX_GB=0
+
 # Destination container on the source. Qcow2 files will be placed here by AHV.
 EXPORTCONTAINER = "exportcontainer"
 
@@ -31,12 +92,71 @@ EXPORTCONTAINER = "exportcontainer"
 COMPRESS=""
 #COMPRESS="-c"
 
+# Set to True to compress the qcow2 files on this system instead of on the CVMs. Every downloaded
+# qcow2 file is compressed in blocks on all the cores of this system into <file>.qcow2.zblk, which
+# takes its place in DIR. The import script decompresses it, again on all cores, into STAGING_DIR
+# while the file before it is uploading. STAGING_DIR must be on the import system and have room for
+# a few qcow2 files. Leave COMPRESS empty if you use this.
+LOCAL_COMPRESS=False
+#LOCAL_COMPRESS=True
+STAGING_DIR="/var/tmp/export-import"
+
+# Set to True to keep every piece of data only once on the removeable drive. VMs cloned from the same
+# image have most of their data in common, and so do their qcow2 files. Every downloaded qcow2 file
+# is cut into chunks at places that depend on its content, and the chunks we don't have yet go into
+# a chunk store in DIR/chunks. The qcow2 file is replaced by <file>.qcow2.recipe, the list of its
+# chunks. The import script puts the qcow2 file back together from its chunks in STAGING_DIR before
+# uploading it. With LOCAL_COMPRESS, the chunks are compressed.
+DEDUP_STORE=False
+#DEDUP_STORE=True
+
+# Disabled by default. A vdisk bigger than SHARD_GB is converted as shards of SHARD_GB each, so one
+# huge disk is converted on several CVMs at the same time instead of on one, and its shards download
+# side by side. Each shard is a qcow2 file of its own, <vm_uuid>_<disk_label>.shard<N>.qcow2, and
+# <vm_uuid>_<disk_label>.shards in DIR says where each one goes. The import script converts every
+# shard straight into its place in the raw disk. Needs qemu-img 2.11 or later on the CVMs of both
+# clusters. 0 means disks are never split. 256 is a good size to turn it on with.
+SHARD_GB=0
+#SHARD_GB=256
+
 # Enabled by default. This increases buffer sizes for faster file transfers.
 # Disable if your network is very busy and large packet size may result in excessive re-transmits.
 # Otherwise there is really no need to change this.
 large_file_opt=True
 #large_file_opt=False
 
+# Most bandwidth all downloads, uploads and REST calls of a script may use together, in MB/s. Every
+# transfer gets an equal share, and shares one doesn't use go to the others. 0 means no limit.
+# BANDWIDTH_SCHEDULE changes this by time of day. Each entry is ["HH:MM", "HH:MM", MB/s], from and to.
+# The first entry the time of day falls into wins, and an entry can run past midnight. For example,
+# BANDWIDTH_SCHEDULE=[["07:00", "19:00", 20]] keeps to 20 MB/s during the day, and has no limit
+# overnight. To change the limit while a script is running, write the MB/s into BANDWIDTH_CONTROL
+# in DIR. It is read every 10 seconds, or right away after "kill -USR1 <pid of the script>", and
+# applies until the file is removed.
+BANDWIDTH_LIMIT=0
+BANDWIDTH_SCHEDULE=[]
+BANDWIDTH_CONTROL="bandwidth"
+
+# Number of times a failed download or upload is retried before we give up on that file.
+# Every retry waits twice as long as the one before it, starting at RETRY_DELAY seconds.
+# With RESUME_TRANSFERS enabled, a retry carries on from the last byte that made it to the
+# other side (sftp reget/reput) instead of starting over. Disable it only if your sftp client
+# is too old to know about reget and reput. A transfer only carries on into a file that this run,
+# or an earlier one, was transferring for the same version of the disk, going by the journal. Any
+# other file by that name is written over.
+TRANSFER_RETRIES=5
+RETRY_DELAY=5
+RESUME_TRANSFERS=True
+#RESUME_TRANSFERS=False
+
+# Enabled by default. Every qcow2 file is checksummed while it is downloaded and uploaded, a block
+# at a time, right behind the transfer so the bytes are still in memory. The block checksums are
+# saved in DIR next to each qcow2 file (<vm_uuid>_<disk_label>.sums) and checked against the sftp
+# server on the CVM once the transfer is done. CHECKSUM_THREADS blocks are hashed at the same time.
+CHECKSUMS=True
+#CHECKSUMS=False
+CHECKSUM_THREADS=4
+
 # Source AHV cluster details. We need these in order to log into the REST API.
 src_cluster_ip = "10.254.254.254"
 src_cluster_admin = "restapiuser"
@@ -55,6 +175,10 @@ SFTPCONTAINER = "sftpcontainer"
 # You can go to Prism-> Network -> Virtual Networks and get this information.
 MYNETWORK = "server lan" 
 
+# Number of VMs the import script creates and powers on at the same time. Each VM is created
+# as soon as all of its own disks are uploaded and converted.
+MAX_VM_CREATES=4
+
 # Drives with these parameters on the source will be considered boot devices on the destination.
 # The script takes these parameters and changes these to scsi:0, because POST /vms seems to require
 # the boot drive being that way.
@@ -75,6 +199,814 @@ dst_cvm_pwd = "blahblah"
 VM_SUFFIX="_TEST-1103_1200"
 
 # ========== DO NOT CHANGE ANYTHING UNDER THIS LINE =====
+# Most REST requests we send to a cluster at the same time, when we have a lot of them to make.
+REST_THREADS=8
+
+# Directory on the CVMs where conversion jobs leave their exit code and, if they fail, their output.
+CVM_JOB_DIR="/home/nutanix/tmp/export-import-jobs"
+
+# The export keeps an index of the VMs and disks it put in DIR in this file:
+# {"vms": {vm_uuid: {"name", "uuid", "cfg", "exported", "disks": [{"filename", "disk_label",
+#  "vmdisk_uuid", "size", "bytes", "sha256", "sums"}]}}}
+# size is the size of the vdisk on the source, bytes the size of its qcow2 file in DIR (None if it
+# never made it there). sha256 is its checksum, and sums the file with its block checksums.
+# The import reads this instead of scanning DIR and every config file in it.
+MANIFEST="manifest.json"
+
+# Return the manifest in DIR, or None if there isn't one we can read.
+def load_manifest():
+
+    try:
+        fp = open(DIR + "/" + MANIFEST, "r")
+    except OSError:
+        return None
+    try:
+        manifest = json.load(fp)
+    except ValueError as ex:
+        print(">>> Cannot read %s/%s: %s <<<" % (DIR, MANIFEST, ex))
+        manifest = None
+    fp.close()
+    return manifest
+
+# Write the manifest to a temporary file first and rename it over the old one, so a full drive or
+# a crash never leaves half a manifest behind.
+def save_manifest(manifest):
+
+    tmpfile = DIR + "/." + MANIFEST + ".tmp"
+    fp = open(tmpfile, "w")
+    json.dump(manifest, fp, separators=(",", ":"), sort_keys=True)
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+    os.replace(tmpfile, DIR + "/" + MANIFEST)
+
+# The block checksums of the qcow2 file filename in DIR are kept next to it, in a file with the same
+# name ending in .sums.
+def checksum_file(filename):
+    return re.sub(".qcow2$", ".sums", filename)
+
+def save_checksum(filename,checksum):
+
+    fp = open(DIR + "/" + checksum_file(filename), "w")
+    json.dump(checksum, fp)
+    fp.close()
+
+# Return the checksum we saved for filename, or None if there isn't one.
+def load_checksum(filename):
+
+    try:
+        fp = open(DIR + "/" + checksum_file(filename), "r")
+    except OSError:
+        return None
+    try:
+        checksum = json.load(fp)
+    except ValueError:
+        checksum = None
+    fp.close()
+    return checksum
+
+# Files are checksummed CHECKSUM_BLOCK bytes at a time. The checksum of a whole file is the sha256
+# of the sha256 of all of its blocks, one after the other, so the blocks can be hashed in parallel.
+CHECKSUM_BLOCK=64*1048576
+checksum_pool = None
+checksum_pool_lock = threading.Lock()
+
+# Return the sha256 of block number index of path.
+def hash_block(path,index):
+
+    h = hashlib.sha256()
+    fp = open(path, "rb")
+    fp.seek(index * CHECKSUM_BLOCK)
+    left = CHECKSUM_BLOCK
+    while left > 0:
+        buf = fp.read(min(left, 1048576))
+        if len(buf) == 0:
+            break
+        h.update(buf)
+        left -= len(buf)
+    fp.close()
+    return h.digest()
+
+# Hashes path a block at a time as it is transferred. feed() is given the number of bytes that made
+# it so far and hands every block that is complete to a pool of CHECKSUM_THREADS threads. hashlib
+# lets go of the GIL while it hashes, so this runs alongside the transfers. Blocks closer than lag
+# bytes to the end are left alone, because sftp doesn't always write a file in order.
+# result() hashes whatever is left once the transfer is done.
+class stream_checksum():
+    def __init__(self,path,lag=0):
+
+        global checksum_pool
+        with checksum_pool_lock:
+            if checksum_pool is None:
+                checksum_pool = concurrent.futures.ThreadPoolExecutor(max(1, CHECKSUM_THREADS))
+        self.path = path
+        self.lag = lag
+        self.lock = threading.Lock()
+        self.reset()
+
+    # The file is being written again from the start. Forget the blocks we hashed.
+    def reset(self):
+
+        with self.lock:
+            self.blocks = {}
+            self.next_block = 0
+
+    def feed(self,bytes_done):
+
+        with self.lock:
+            while (self.next_block + 1) * CHECKSUM_BLOCK + self.lag <= bytes_done:
+                self.blocks[self.next_block] = checksum_pool.submit(hash_block, self.path, self.next_block)
+                self.next_block += 1
+
+    # Return {"block_size", "blocks", "sha256"} for the first size bytes of the file.
+    # blocks has the sha256 of every block.
+    def result(self,size):
+
+        nblocks = (size + CHECKSUM_BLOCK - 1) // CHECKSUM_BLOCK
+        with self.lock:
+            for i in range(self.next_block, nblocks):
+                self.blocks[i] = checksum_pool.submit(hash_block, self.path, i)
+            self.next_block = max(self.next_block, nblocks)
+            blocks = [self.blocks[i] for i in range(nblocks)]
+        h = hashlib.sha256()
+        digests = []
+        for block in blocks:
+            digest = block.result()
+            h.update(digest)
+            digests.append(digest.hex())
+        return {"block_size": CHECKSUM_BLOCK, "blocks": digests, "sha256": h.hexdigest()}
+
+# Return the sha256 of a whole file from the sha256 of its blocks, as hex strings.
+def blocks_sha256(blocks):
+
+    h = hashlib.sha256()
+    for block in blocks:
+        h.update(bytes.fromhex(block))
+    return h.hexdigest()
+
+# LOCAL_COMPRESS files look like this:
+# ZBLK_MAGIC | every ZBLK_BLOCK bytes of the file compressed with zlib, one after the other |
+# index | offset of the index, 8 bytes big endian.
+# The index is JSON: {"block_size", "size", "blocks": [[offset, length], ...]}. Every block can be
+# found and decompressed by itself, so they are compressed and decompressed in parallel.
+ZBLK_MAGIC=b"EXPZBLK1"
+ZBLK_BLOCK=4*1048576
+ZBLK_SUFFIX=".zblk"
+zblk_pool = None
+zblk_pool_lock = threading.Lock()
+
+def get_zblk_pool():
+
+    global zblk_pool
+    with zblk_pool_lock:
+        if zblk_pool is None:
+            zblk_pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1)
+    return zblk_pool
+
+def zblk_compress_block(fd,offset):
+    return zlib.compress(os.pread(fd, ZBLK_BLOCK, offset))
+
+def zblk_decompress_block(fd,offset,length):
+    return zlib.decompress(os.pread(fd, length, offset))
+
+# Return the index of the compressed file path, or None if it isn't a complete one.
+def zblk_index(path):
+
+    try:
+        fp = open(path, "rb")
+    except OSError:
+        return None
+    try:
+        if fp.read(len(ZBLK_MAGIC)) != ZBLK_MAGIC:
+            return None
+        fp.seek(-8, os.SEEK_END)
+        index_offset = struct.unpack(">Q", fp.read(8))[0]
+        fp.seek(index_offset)
+        index = json.loads(fp.read()[:-8])
+    except (OSError, ValueError, struct.error):
+        index = None
+    fp.close()
+    return index
+
+# Compress srcpath into dstpath. zlib lets go of the GIL, so every core gets a block. We keep a
+# couple of blocks per core in flight and write them out in order.
+def zblk_compress(srcpath,dstpath):
+
+    pool = get_zblk_pool()
+    window = 2 * (os.cpu_count() or 1)
+    size = os.stat(srcpath).st_size
+    fd = os.open(srcpath, os.O_RDONLY)
+    tmppath = dstpath + ".tmp"
+    out = open(tmppath, "wb")
+    out.write(ZBLK_MAGIC)
+    offset = len(ZBLK_MAGIC)
+    blocks = []
+    pending = []
+    next_block = 0
+    try:
+        while next_block * ZBLK_BLOCK < size or len(pending) > 0:
+            while len(pending) < window and next_block * ZBLK_BLOCK < size:
+                pending.append(pool.submit(zblk_compress_block, fd, next_block * ZBLK_BLOCK))
+                next_block += 1
+            data = pending.pop(0).result()
+            out.write(data)
+            blocks.append([offset, len(data)])
+            offset += len(data)
+        out.write(json.dumps({"block_size": ZBLK_BLOCK, "size": size, "blocks": blocks}).encode())
+        out.write(struct.pack(">Q", offset))
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        os.close(fd)
+        out.close()
+    os.replace(tmppath, dstpath)
+
+# Decompress srcpath into dstpath, every core on its own block. Blocks are written where they
+# belong as soon as they are done.
+def zblk_decompress(srcpath,dstpath):
+
+    index = zblk_index(srcpath)
+    if index is None:
+        raise ValueError("%s is not a complete compressed file" % srcpath)
+    pool = get_zblk_pool()
+    window = 2 * (os.cpu_count() or 1)
+    fd = os.open(srcpath, os.O_RDONLY)
+    out = os.open(dstpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    pending = []
+    try:
+        for i, (offset, length) in enumerate(index["blocks"]):
+            pending.append([i, pool.submit(zblk_decompress_block, fd, offset, length)])
+            while len(pending) >= window or (len(pending) > 0 and i == len(index["blocks"]) - 1):
+                j, block = pending.pop(0)
+                os.pwrite(out, block.result(), j * index["block_size"])
+        os.ftruncate(out, index["size"])
+    finally:
+        os.close(fd)
+        os.close(out)
+    return index["size"]
+
+# DEDUP_STORE. Chunks end on a qcow2 cluster boundary, so the same data always lines up the same way
+# in two qcow2 files, even when it is at a different place in each. A chunk is at least CHUNK_MIN and
+# at most CHUNK_MAX clusters. In between, it ends after a cluster whose sha256 divides by CHUNK_AVG,
+# so where chunks end depends on the data and not on where it is. A chunk is known by the sha256 of
+# the sha256 of its clusters.
+# The chunks are appended to DIR/chunks/pack.<n>, which are never bigger than PACK_BYTES so they fit
+# on a FAT32 drive. DIR/chunks/index has a CHUNK_RECORD for every chunk: its sha256, the pack it is
+# in, where it is, how many bytes it takes there, and 1 if it is compressed.
+# A recipe starts with RECIPE_MAGIC and the size of the file, followed by a RECIPE_RECORD (sha256 and
+# size) for every chunk of the file.
+CHUNK_DIR="chunks"
+CHUNK_MIN=4
+CHUNK_AVG=16
+CHUNK_MAX=64
+PACK_BYTES=1024*1048576
+CHUNK_RECORD=struct.Struct(">32sIQIB")
+RECIPE_MAGIC=b"EXPRCP01"
+RECIPE_RECORD=struct.Struct(">32sI")
+RECIPE_SUFFIX=".recipe"
+
+# Return the cluster size of the qcow2 file path, or 64k if it doesn't look like one.
+def qcow2_cluster_size(path):
+
+    try:
+        fp = open(path, "rb")
+        header = fp.read(24)
+        fp.close()
+    except OSError:
+        return 65536
+    if len(header) == 24 and header[:4] == b"QFI\xfb":
+        return 1 << struct.unpack(">I", header[20:24])[0]
+    return 65536
+
+# Cut path into chunks. Yield the sha256 and the data of every chunk.
+def file_chunks(path):
+
+    cluster_size = qcow2_cluster_size(path)
+    fp = open(path, "rb")
+    clusters = []
+    h = hashlib.sha256()
+    try:
+        while True:
+            cluster = fp.read(cluster_size)
+            if len(cluster) == 0:
+                break
+            digest = hashlib.sha256(cluster).digest()
+            clusters.append(cluster)
+            h.update(digest)
+            if len(clusters) >= CHUNK_MAX or \
+               (len(clusters) >= CHUNK_MIN and int.from_bytes(digest[:4], "big") % CHUNK_AVG == 0):
+                yield h.digest(), b"".join(clusters)
+                clusters = []
+                h = hashlib.sha256()
+        if len(clusters) > 0:
+            yield h.digest(), b"".join(clusters)
+    finally:
+        fp.close()
+
+# Return the size of the file in recipe path, or None if it isn't a complete recipe.
+def recipe_size(path):
+
+    try:
+        fp = open(path, "rb")
+        header = fp.read(len(RECIPE_MAGIC) + 8)
+        fp.close()
+    except OSError:
+        return None
+    if len(header) != len(RECIPE_MAGIC) + 8 or header[:len(RECIPE_MAGIC)] != RECIPE_MAGIC:
+        return None
+    return struct.unpack(">Q", header[len(RECIPE_MAGIC):])[0]
+
+# The chunk store in DIR/chunks. Several download threads add files to it at the same time.
+class chunk_store():
+    def __init__(self,path):
+
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # Key is the sha256 of a chunk, value is [pack, offset, length, compressed].
+        self.index = {}
+        # Chunks that are in a pack but not in the index file yet. See sync().
+        self.unsynced = []
+        indexfile = path + "/index"
+        try:
+            fp = open(indexfile, "rb")
+            data = fp.read()
+            fp.close()
+        except OSError:
+            data = b""
+        nrecords = len(data) // CHUNK_RECORD.size
+        for i in range(nrecords):
+            digest, pack, offset, length, compressed = CHUNK_RECORD.unpack_from(data, i * CHUNK_RECORD.size)
+            self.index[digest] = [pack, offset, length, compressed]
+        # A record that is cut short never made it. The chunk gets stored again.
+        if len(data) != nrecords * CHUNK_RECORD.size:
+            os.truncate(indexfile, nrecords * CHUNK_RECORD.size)
+        self.index_fp = open(indexfile, "ab")
+        self.pack = 0
+        for f in os.listdir(path):
+            if re.match("^pack\\.\\d+$", f):
+                self.pack = max(self.pack, int(f.split(".")[1]))
+        self.pack_fp = open(self.pack_file(self.pack), "ab")
+        self.readers = {}
+
+    def pack_file(self,pack):
+        return "%s/pack.%d" % (self.path, pack)
+
+    # Store a chunk unless we have it already. Return True if it is new.
+    def put(self,digest,data):
+
+        with self.lock:
+            if digest in self.index:
+                return False
+        compressed = 0
+        if LOCAL_COMPRESS == True:
+            data = zlib.compress(data)
+            compressed = 1
+        with self.lock:
+            if digest in self.index:
+                return False
+            offset = self.pack_fp.tell()
+            if offset > 0 and offset + len(data) > PACK_BYTES:
+                self.pack_fp.flush()
+                os.fsync(self.pack_fp.fileno())
+                self.pack_fp.close()
+                self.pack += 1
+                self.pack_fp = open(self.pack_file(self.pack), "ab")
+                offset = 0
+            self.pack_fp.write(data)
+            self.index[digest] = [self.pack, offset, len(data), compressed]
+            self.unsynced.append(digest)
+        return True
+
+    # Make sure every chunk we stored so far is on the drive before any recipe refers to it. The data
+    # goes first and the index after, so the index never points at data that isn't there.
+    def sync(self):
+
+        with self.lock:
+            self.pack_fp.flush()
+            os.fsync(self.pack_fp.fileno())
+            for digest in self.unsynced:
+                self.index_fp.write(CHUNK_RECORD.pack(digest, *self.index[digest]))
+            self.unsynced = []
+            self.index_fp.flush()
+            os.fsync(self.index_fp.fileno())
+
+    def get(self,digest):
+
+        with self.lock:
+            pack, offset, length, compressed = self.index[digest]
+            if pack == self.pack:
+                self.pack_fp.flush()
+            if pack not in self.readers:
+                self.readers[pack] = os.open(self.pack_file(pack), os.O_RDONLY)
+            fd = self.readers[pack]
+        data = os.pread(fd, length, offset)
+        if compressed:
+            data = zlib.decompress(data)
+        return data
+
+    # Store the chunks of srcpath and write its recipe to recipepath.
+    # Return the size of srcpath and how many of its bytes were new to the store.
+    def add_file(self,srcpath,recipepath):
+
+        records = []
+        size = 0
+        new_bytes = 0
+        for digest, data in file_chunks(srcpath):
+            if self.put(digest, data):
+                new_bytes += len(data)
+            records.append(RECIPE_RECORD.pack(digest, len(data)))
+            size += len(data)
+        self.sync()
+        tmppath = recipepath + ".tmp"
+        fp = open(tmppath, "wb")
+        fp.write(RECIPE_MAGIC + struct.pack(">Q", size))
+        fp.write(b"".join(records))
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.replace(tmppath, recipepath)
+        return size, new_bytes
+
+    # Put the file in recipepath back together in dstpath. Return its size.
+    def rebuild(self,recipepath,dstpath):
+
+        size = recipe_size(recipepath)
+        if size is None:
+            raise ValueError("%s is not a complete recipe" % recipepath)
+        fp = open(recipepath, "rb")
+        fp.seek(len(RECIPE_MAGIC) + 8)
+        out = open(dstpath, "wb")
+        try:
+            while True:
+                record = fp.read(RECIPE_RECORD.size)
+                if len(record) < RECIPE_RECORD.size:
+                    break
+                digest, length = RECIPE_RECORD.unpack(record)
+                data = self.get(digest)
+                if len(data) != length:
+                    raise ValueError("chunk %s of %s is %d bytes, not %d" % (digest.hex(), recipepath, len(data), length))
+                out.write(data)
+        finally:
+            fp.close()
+            out.close()
+        if os.stat(dstpath).st_size != size:
+            raise ValueError("%s did not add up to %d bytes" % (recipepath, size))
+        return size
+
+# The chunk store in DIR. We only open it, and read its index, if we need it.
+store = None
+store_lock = threading.Lock()
+
+def get_chunk_store():
+
+    global store
+    with store_lock:
+        if store is None:
+            store = chunk_store(DIR + "/" + CHUNK_DIR)
+    return store
+
+# The drive probe writes, syncs and reads back PROBE_BYTES in DIR. We allow one transfer for every
+# STREAM_RATE bytes per second the drive can do, which is about what one sftp transfer moves. A drive
+# that takes longer than SLOW_FSYNC seconds to sync is a spinning disk, and doesn't get more than 2
+# transfers, because it spends its time seeking between them. Every ADAPT_INTERVAL seconds we look at
+# how fast the transfers went and change how many we run.
+# A drive is only probed once. What we found is kept in PROBE_CACHE, by the filesystem it has in DIR.
+PROBE_BYTES=256*1048576
+STREAM_RATE=50*1048576
+SLOW_FSYNC=0.01
+ADAPT_INTERVAL=30
+PROBE_CACHE=os.path.expanduser("~/.export-import-drives.json")
+
+# Return what probe_drive() found for the drive path is on, from PROBE_CACHE if it was measured
+# before. Return None if we couldn't measure it.
+def drive_speed(path):
+
+    try:
+        drive = "%s:%x" % (os.path.realpath(path), os.statvfs(path).f_fsid)
+    except OSError:
+        return probe_drive(path)
+    try:
+        fp = open(PROBE_CACHE, "r")
+        probes = json.load(fp)
+        fp.close()
+    except (OSError, ValueError):
+        probes = {}
+    if drive in probes:
+        probe = probes[drive]
+        print("%s writes %0.2f MB/s, reads %0.2f MB/s, and takes %0.1f ms to sync, as measured before. " \
+              "Remove %s to measure it again." \
+              % (path, probe["write"] / 1048576, probe["read"] / 1048576, probe["fsync"] * 1000, PROBE_CACHE))
+        return probe
+    probe = probe_drive(path)
+    if probe is not None:
+        probes[drive] = probe
+        try:
+            fp = open(PROBE_CACHE, "w")
+            json.dump(probes, fp)
+            fp.close()
+        except OSError as ex:
+            print("Could not save the speed of %s: %s" % (path, ex))
+    return probe
+
+# Measure the drive path is on. Return {"write", "read", "fsync"}, the first two in bytes per second
+# and fsync in seconds, or None if we couldn't.
+def probe_drive(path):
+
+    probefile = path + "/.drive-probe"
+    buf = os.urandom(1048576)
+    try:
+        fp = open(probefile, "wb")
+        start_time = time.time()
+        for i in range(PROBE_BYTES // len(buf)):
+            fp.write(buf)
+        fp.flush()
+        os.fsync(fp.fileno())
+        write_time = time.time() - start_time
+
+        # Small synchronous writes, like a transfer that gets its data in bits.
+        start_time = time.time()
+        for i in range(8):
+            fp.write(buf[:4096])
+            fp.flush()
+            os.fsync(fp.fileno())
+        fsync_time = (time.time() - start_time) / 8
+        fp.close()
+
+        # Drop the file from the page cache so we read it off the drive.
+        fd = os.open(probefile, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        start_time = time.time()
+        while len(os.read(fd, len(buf))) > 0:
+            pass
+        read_time = time.time() - start_time
+        os.close(fd)
+        os.remove(probefile)
+    except OSError as ex:
+        print("Could not measure the drive in %s: %s" % (path, ex))
+        return None
+    probe = {"write": PROBE_BYTES / max(write_time, 0.001), "read": PROBE_BYTES / max(read_time, 0.001), \
+             "fsync": fsync_time}
+    print("%s writes %0.2f MB/s, reads %0.2f MB/s, and takes %0.1f ms to sync." \
+          % (path, probe["write"] / 1048576, probe["read"] / 1048576, probe["fsync"] * 1000))
+    return probe
+
+# Decides how many transfers run at the same time, between low and high. A transfer calls acquire()
+# before it starts and release() once it is done. Every ADAPT_INTERVAL seconds we add up how many
+# bytes all transfers moved, from their transfer_progress. While everything we allow is running and
+# that keeps going up, we allow one more transfer. If it stays below what we had with this many
+# transfers for ADAPT_DROPS intervals in a row, the drive or the link can't keep up, and we halve the
+# number of transfers. A single slow interval is just the network. We then stay below the number
+# that was too many for ADAPT_HOLD intervals, before we try it again.
+ADAPT_HOLD=10
+ADAPT_DROPS=3
+class adaptive_limit():
+    def __init__(self,start,low,high):
+
+        self.limit = max(low, min(start, high))
+        self.low = low
+        self.high = high
+        self.ceiling = high
+        self.hold = 0
+        self.active = 0
+        self.cond = threading.Condition()
+        # Bytes moved by every transfer we heard about, keyed by its transfer_progress.
+        self.moved = {}
+        self.stop = threading.Event()
+        progress_callbacks.append(self.on_progress)
+        self.thread = threading.Thread(target=self.adapt, daemon=True)
+        self.thread.start()
+
+    def acquire(self):
+
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self):
+
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def on_progress(self,progress):
+
+        with self.cond:
+            self.moved[progress] = max(progress.bytes_done - progress.offset, 0)
+
+    def adapt(self):
+
+        last_total = 0
+        # The rate we had before we last added a transfer, and how many intervals in a row we were below it.
+        last_rate = None
+        drops = 0
+        last_time = time.time()
+        while not self.stop.wait(ADAPT_INTERVAL):
+            cur_time = time.time()
+            with self.cond:
+                total = sum(self.moved.values())
+                busy = self.active >= self.limit
+            rate = max(total - last_total, 0) / max(cur_time - last_time, 1)
+            last_total = total
+            last_time = cur_time
+            # If we don't have enough files to fill every slot, we can't tell if more would help.
+            if not busy:
+                last_rate = None
+                drops = 0
+                continue
+            if last_rate is not None and rate < last_rate * 0.9:
+                drops += 1
+            else:
+                drops = 0
+            with self.cond:
+                limit = self.limit
+                if self.hold > 0:
+                    self.hold -= 1
+                    if self.hold == 0:
+                        self.ceiling = self.high
+                if drops >= ADAPT_DROPS:
+                    self.ceiling = max(self.low, self.limit - 1)
+                    self.hold = ADAPT_HOLD
+                    self.limit = max(self.low, self.limit // 2)
+                    last_rate = rate
+                    drops = 0
+                elif drops == 0 and (last_rate is None or rate > last_rate * 1.05):
+                    self.limit = min(self.ceiling, self.limit + 1)
+                    last_rate = rate
+                self.cond.notify_all()
+                if self.limit != limit:
+                    print("Moved %0.2f MB/s with %d transfers. Running %d at a time now." \
+                          % (rate / 1048576, limit, self.limit))
+
+    def close(self):
+
+        self.stop.set()
+        if self.on_progress in progress_callbacks:
+            progress_callbacks.remove(self.on_progress)
+
+# Decide how many transfers that write to DIR (direction "write") or read from it ("read") we run.
+# streams is what --streams said, if anything. Return the most transfers we run, and an adaptive_limit
+# that decides how many of them run at any time, or None if we always run them all.
+def transfer_limit(streams,direction):
+
+    if streams is not None:
+        return streams, None
+    if ADAPTIVE_TRANSFERS == False:
+        return MAX_TRANSFERS, None
+    high = max(1, MAX_ADAPTIVE_TRANSFERS)
+    probe = drive_speed(DIR)
+    if probe is not None:
+        high = max(1, min(high, int(probe[direction] / STREAM_RATE)))
+        if probe["fsync"] > SLOW_FSYNC:
+            high = min(high, 2)
+    print("Transferring between 1 and %d files at a time, depending on how fast they go." % high)
+    return high, adaptive_limit(1, 1, high)
+
+# Both scripts keep a journal of how far every VM and disk got in DIR/JOURNAL, so a run that stopped
+# half way can be started again and skip what is done. Remove the file to start over.
+# The export takes each disk through EXPORT_STEPS, the import takes disks and VMs through IMPORT_STEPS.
+# If DIR is read-only, say for an import from a write protected drive, the journal is kept in
+# JOURNAL_FALLBACK instead, and if we can't write there either, only for this run.
+JOURNAL="journal.sqlite"
+JOURNAL_FALLBACK=os.path.expanduser("~/.export-import-" + JOURNAL)
+EXPORT_STEPS=["listed", "converted", "transferring", "transferred", "verified"]
+IMPORT_STEPS=["listed", "transferring", "transferred", "verified", "converted", "created", "powered_on"]
+
+# side is "export" or "import", the same drive can have both. Every step is written to the drive
+# before done() returns, so a crash never loses a step that was reported done, or records one that
+# wasn't. The download, upload and conversion threads all use the one journal.
+class run_journal():
+    def __init__(self,side,steps):
+
+        self.side = side
+        self.steps = steps
+        self.lock = threading.Lock()
+        for path in [DIR + "/" + JOURNAL, JOURNAL_FALLBACK, ":memory:"]:
+            # sqlite opens a database it can't write to, and only fails on the first write.
+            if path != ":memory:" and (not os.access(os.path.dirname(path), os.W_OK) or \
+                                       (os.path.exists(path) and not os.access(path, os.W_OK))):
+                print("Cannot write the journal to %s." % path)
+                continue
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+                self.db.execute("PRAGMA synchronous=FULL")
+                self.db.execute("CREATE TABLE IF NOT EXISTS steps (side TEXT, kind TEXT, name TEXT, key TEXT, " + \
+                                "step TEXT, detail TEXT, updated REAL, PRIMARY KEY (side, kind, name))")
+            except sqlite3.Error as ex:
+                print("Cannot write the journal to %s: %s" % (path, ex))
+                continue
+            if path == ":memory:":
+                print(">>> Keeping the journal for this run only. A run after it starts over. <<<")
+            elif path != DIR + "/" + JOURNAL:
+                print("Keeping the journal in %s." % path)
+            break
+
+    # A "vm" or "disk" called name is part of this run. key says which version of it this is. If the
+    # journal has it under a different key, it changed since, and starts over.
+    def listed(self,kind,name,key):
+
+        with self.lock:
+            row = self.db.execute("SELECT key FROM steps WHERE side=? AND kind=? AND name=?", \
+                                  (self.side, kind, name)).fetchone()
+            if row is None or row[0] != key:
+                self.db.execute("INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, NULL, ?)", \
+                                (self.side, kind, name, key, self.steps[0], time.time()))
+
+    # Return how far name got, and what we noted down for it.
+    def get(self,kind,name):
+
+        with self.lock:
+            row = self.db.execute("SELECT step, detail FROM steps WHERE side=? AND kind=? AND name=?", \
+                                  (self.side, kind, name)).fetchone()
+        if row is None:
+            return self.steps[0], None
+        return row[0], row[1]
+
+    # Return the key name is listed under, or None if it isn't.
+    def key(self,kind,name):
+
+        with self.lock:
+            row = self.db.execute("SELECT key FROM steps WHERE side=? AND kind=? AND name=?", \
+                                  (self.side, kind, name)).fetchone()
+        return None if row is None else row[0]
+
+    # Return True if name got through step.
+    def reached(self,kind,name,step):
+
+        current, detail = self.get(kind, name)
+        return self.steps.index(current) >= self.steps.index(step)
+
+    # name got through step. detail is anything we need to carry on from there.
+    def done(self,kind,name,step,detail=None):
+
+        with self.lock:
+            row = self.db.execute("SELECT step FROM steps WHERE side=? AND kind=? AND name=?", \
+                                  (self.side, kind, name)).fetchone()
+            if row is not None and self.steps.index(row[0]) > self.steps.index(step):
+                return
+            self.db.execute("UPDATE steps SET step=?, detail=COALESCE(?, detail), updated=? " + \
+                            "WHERE side=? AND kind=? AND name=?", \
+                            (step, detail, time.time(), self.side, kind, name))
+
+# exportvm_on_source.py --incremental exports the changes to each vdisk since the last export, as
+# <vm_uuid>_<disk_label>.delta.qcow2. The import script applies it to the disk it imported last time.
+# The manifest entry of a delta has the filename, bytes and sha256 of the qcow2 file it was made from
+# under "base", and the import script only applies it on top of that file.
+DELTA_SUFFIX=".delta.qcow2"
+
+# Return the qcow2 file of the export that the delta filename is based on.
+def delta_base(filename):
+    return filename[:-len(DELTA_SUFFIX)] + ".qcow2"
+
+# A vdisk bigger than SHARD_GB is exported as shards. See SHARD_GB.
+SHARD_REGEX=r"\.shard(\d+)\.qcow2$"
+
+# Return the [offset, length] of every shard of a vdisk of size bytes, or None if it isn't split.
+def shard_ranges(size):
+    shard_bytes = SHARD_GB * 1073741824
+    if shard_bytes <= 0 or size <= shard_bytes:
+        return None
+    return [[offset, min(shard_bytes, size - offset)] for offset in range(0, size, shard_bytes)]
+
+def shard_filename(filename,n):
+    return re.sub(".qcow2$", ".shard%03d.qcow2" % n, filename)
+
+# Return the qcow2 file of the whole disk that filename is a shard of. Or filename itself if it is
+# not a shard.
+def shard_of(filename):
+    return re.sub(SHARD_REGEX, ".qcow2", filename)
+
+def shard_index_file(filename):
+    return re.sub(".qcow2$", ".shards", shard_of(filename))
+
+# Save where each shard of filename goes, in DIR. shards is a list of [shard filename, offset, length],
+# size is the size of the vdisk.
+def save_shard_index(filename,size,shards):
+    fp = open(DIR + "/" + shard_index_file(filename), "w")
+    json.dump({"size": size, "shards": shards}, fp)
+    fp.close()
+
+# Return the size of the vdisk that filename is a shard of, and the [offset, length] of the shard in
+# it. Return None if filename is not a shard, or its index is not in DIR.
+def shard_range(filename):
+    if re.search(SHARD_REGEX, filename) is None:
+        return None
+    try:
+        fp = open(DIR + "/" + shard_index_file(filename), "r")
+        index = json.load(fp)
+        fp.close()
+    except (IOError, ValueError):
+        return None
+    for shard in index["shards"]:
+        if shard[0] == filename:
+            return index["size"], shard[1:]
+    return None
+
+# How long to sleep before retry number attempt of a transfer. Doubles every time, capped at 5 minutes.
+def backoff(attempt):
+    return min(RETRY_DELAY * (2 ** (attempt - 1)), 300)
+
 class my_api():
     def __init__(self,ip,username,password):
 
@@ -94,6 +1026,17 @@ class my_api():
         base_urlv2 = 'https://%s:9440/PrismGateway/services/rest/v2.0/'
         self.base_urlv2 = base_urlv2 % self.ip_addr
         self.sessionv2 = self.get_server_session(self.username, self.password)
+        # One authenticated SSH connection per CVM, keyed by CVM IP. See get_ssh().
+        # ssh_lock only guards the two dicts. Each CVM has its own lock in ssh_locks, held while we
+        # connect to it, so a CVM that doesn't answer only holds up the threads that want that CVM.
+        self.ssh_clients = {}
+        self.ssh_locks = {}
+        self.ssh_lock = threading.Lock()
+        # One sftp session to the cluster (port 2222), for everything we do to files in a container
+        # ourselves. See with_sftp().
+        self.sftp_lock = threading.Lock()
+        self.transport = None
+        self.sftp = None
         
     def get_server_session(self, username, password):
           
@@ -103,8 +1046,40 @@ class my_api():
         session.auth = (username, password)
         session.verify = False
         session.headers.update({'Content-Type': 'application/json; charset=utf-8'})
+        session.hooks["response"].append(bandwidth.rest_hook)
         return session
        
+    # Get every entity from a v2 list url, count entities per request. We stop once the metadata says
+    # we have them all, or a page has nothing we haven't seen (some endpoints ignore page and count
+    # and always return everything). Return the status code of the last request and the entities.
+    def get_paged(self,url,count=500):
+
+        entities = []
+        seen = set()
+        page = 1
+        if "?" in url:
+            sep = "&"
+        else:
+            sep = "?"
+        while True:
+            server_response = self.sessionv2.get(url + sep + "page=%d&count=%d" % (page, count))
+            if server_response.status_code != 200:
+                return server_response.status_code, entities
+            resp = json.loads(server_response.text)
+            page_entities = resp.get("entities", [])
+            new = 0
+            for e in page_entities:
+                key = e.get("uuid") or json.dumps(e, sort_keys=True)
+                if key in seen:
+                    continue
+                seen.add(key)
+                entities.append(e)
+                new += 1
+            total = resp.get("metadata", {}).get("grand_total_entities")
+            if new == 0 or len(page_entities) < count or (total is not None and len(entities) >= total):
+                return server_response.status_code, entities
+            page += 1
+
     # Get cluster information.
     def get_cluster_information(self):
         
@@ -129,33 +1104,295 @@ class my_api():
             print(e)
             return False
     
+    # Return an authenticated paramiko SSHClient for cvm_ip. We keep one connection per CVM and
+    # open a new exec channel on it for every command, instead of doing a TCP+SSH handshake and
+    # password login every time. If the connection died or doesn't answer anymore, reconnect.
+    # Raise an exception if we can't.
+    def get_ssh(self,cvm_ip,pwd):
+
+        with self.ssh_lock:
+            cvm_lock = self.ssh_locks.setdefault(cvm_ip, threading.Lock())
+        with cvm_lock:
+            with self.ssh_lock:
+                ssh = self.ssh_clients.get(cvm_ip)
+            if ssh is not None:
+                transport = ssh.get_transport()
+                try:
+                    if transport is not None and transport.is_active():
+                        transport.send_ignore()
+                        return ssh
+                except Exception as ex:
+                    print(ex)
+                print("Lost connection to %s. Reconnecting." % cvm_ip)
+                ssh.close()
+                with self.ssh_lock:
+                    self.ssh_clients.pop(cvm_ip, None)
+
+            ssh = paramiko.SSHClient()
+            ssh.load_system_host_keys()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            # Let the caller decide what to do about a CVM we can't reach. See conversion_jobs.
+            try:
+                ssh.connect(cvm_ip, username="nutanix", password=pwd, timeout=30)
+            except Exception as ex:
+                print("Could not connect to:",cvm_ip)
+                print(ex)
+                raise
+            # Keepalives stop firewalls from dropping the connection while we sleep between checks.
+            ssh.get_transport().set_keepalive(30)
+            with self.ssh_lock:
+                self.ssh_clients[cvm_ip] = ssh
+            return ssh
+
+    # Close every CVM connection we opened, and our sftp session.
+    def close_ssh(self):
+
+        with self.ssh_lock:
+            for ssh in self.ssh_clients.values():
+                ssh.close()
+            self.ssh_clients = {}
+        with self.sftp_lock:
+            self.close_sftp()
+
+    # Run fn(sftp) in our sftp session to the cluster. Return what it returns, or None if that fails.
+    # If the session went away, open a new one.
+    def with_sftp(self,fn):
+
+        with self.sftp_lock:
+            if self.transport is None or not self.transport.is_active():
+                self.close_sftp()
+                try:
+                    self.transport = paramiko.Transport((self.ip_addr, 2222))
+                    self.transport.connect(username=self.username, password=self.password)
+                    self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+                except Exception as ex:
+                    print(ex)
+                    self.close_sftp()
+                    return None
+            try:
+                return fn(self.sftp)
+            except Exception as ex:
+                print(ex)
+                return None
+
+    def close_sftp(self):
+
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+        self.sftp = None
+
+    # Rename src to dst in container, over dst if it is there. Return True if that worked.
+    def sftp_rename(self,container,src,dst):
+
+        def rename(sftp):
+            try:
+                sftp.remove("/" + container + "/" + dst)
+            except IOError:
+                pass
+            sftp.rename("/" + container + "/" + src, "/" + container + "/" + dst)
+            return True
+        return self.with_sftp(rename) is not None
+
+    # Remove filename from container. Return True if it is gone.
+    def sftp_delete(self,container,filename):
+
+        return self.with_sftp(lambda sftp: sftp.remove("/" + container + "/" + filename) or True) is not None
+
     # Ssh into the CVM.
-    def ssh_cmd(self,cvm_ip,pwd,filename,nfs_path):
+    # byte_range is the [offset, length] of a shard (see SHARD_GB) in its vdisk, or None for a whole disk.
+    # If part is given, the job writes its qcow2 (source) or raw (destination) file as part instead,
+    # and its job files in CVM_JOB_DIR are named after part. See PART_SUFFIX.
+    def ssh_cmd(self,cvm_ip,pwd,filename,nfs_path,byte_range=None,part=None):
         
-        ssh = paramiko.SSHClient()
-        ssh.load_system_host_keys()        
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            ssh.connect(cvm_ip, username="nutanix", password=pwd)
-        except Exception as ex:
-            print("Could not connect to:",cvm_ip)
-            print(ex)
-            sys.exit(1)
+        ssh = self.get_ssh(cvm_ip,pwd)
+        output = filename if part is None else part
+        job_file = CVM_JOB_DIR + "/" + output
         
         # Run this on the source cluster.
-        if (nfs_path != None):
-            cmd = "/usr/local/nutanix/bin/qemu-img convert " + COMPRESS + " -f raw nfs://127.0.0.1" + nfs_path + " -O qcow2 nfs://127.0.0.1/" + EXPORTCONTAINER + "/" + filename + " &"
+        # An incremental export (see DELTA_SUFFIX) starts with an empty qcow2 on top of the vdisk, and
+        # rebases it onto the qcow2 file of the last export. qemu-img rebase compares the two and only
+        # writes the clusters that changed into the delta.
+        if (nfs_path != None and filename.endswith(DELTA_SUFFIX)):
+            delta = "nfs://127.0.0.1/" + EXPORTCONTAINER + "/" + output
+            base = "nfs://127.0.0.1/" + EXPORTCONTAINER + "/" + delta_base(filename)
+            cmd = "/usr/local/nutanix/bin/qemu-img create -f qcow2 -F raw -b nfs://127.0.0.1" + nfs_path + " " + delta + \
+                  " && /usr/local/nutanix/bin/qemu-img rebase -f qcow2 -F qcow2 -b " + base + " " + delta
+        # qemu-img convert already leaves zeroed clusters out of the qcow2 file, and out of the raw
+        # file on the destination, so a thin vdisk only moves the data it holds. There is no separate
+        # sparse mode or allocation map.
+        elif (nfs_path != None):
+            cmd = "/usr/local/nutanix/bin/qemu-img convert " + COMPRESS + " -f raw nfs://127.0.0.1" + nfs_path + " -O qcow2 nfs://127.0.0.1/" + EXPORTCONTAINER + "/" + output
+            # A shard only reads its own range of the vdisk, through the offset and size of the raw driver.
+            if byte_range != None:
+                cmd = "/usr/local/nutanix/bin/qemu-img convert " + COMPRESS + " --image-opts driver=raw,offset=%d,size=%d,file.filename=nfs://127.0.0.1" % tuple(byte_range) + nfs_path + " -O qcow2 nfs://127.0.0.1/" + EXPORTCONTAINER + "/" + output
         # Run this on the destination cluster.
+        # A shard is written straight into its range of the raw disk, which create_raw() made.
+        elif byte_range != None:
+            dst_filename = re.sub(".qcow2$", ".raw", shard_of(filename))
+            cmd = "/usr/local/nutanix/bin/qemu-img convert -n -f qcow2 nfs://127.0.0.1/" + SFTPCONTAINER + "/" + filename + " --target-image-opts driver=raw,offset=%d,size=%d,file.filename=nfs://127.0.0.1/" % tuple(byte_range) + SFTPCONTAINER + "/" + dst_filename
+        # A delta goes on top of the raw file the last import left in SFTPCONTAINER, and is then
+        # committed into it. Only the clusters that changed are written.
+        elif filename.endswith(DELTA_SUFFIX):
+            delta = "nfs://127.0.0.1/" + SFTPCONTAINER + "/" + filename
+            base = "nfs://127.0.0.1/" + SFTPCONTAINER + "/" + re.sub(".qcow2$", ".raw", delta_base(filename))
+            cmd = "/usr/local/nutanix/bin/qemu-img rebase -u -f qcow2 -F raw -b " + base + " " + delta + \
+                  " && /usr/local/nutanix/bin/qemu-img commit -f qcow2 " + delta
         else:
-            dst_filename = re.sub(".qcow2", ".raw", filename)
-            cmd = "/usr/local/nutanix/bin/qemu-img convert -f qcow2 nfs://127.0.0.1/" + SFTPCONTAINER + "/" + filename + " -O raw nfs://127.0.0.1/" + SFTPCONTAINER + "/" + dst_filename + " &"
+            dst_filename = re.sub(".qcow2", ".raw", filename) if part is None else part
+            cmd = "/usr/local/nutanix/bin/qemu-img convert -f qcow2 nfs://127.0.0.1/" + SFTPCONTAINER + "/" + filename + " -O raw nfs://127.0.0.1/" + SFTPCONTAINER + "/" + dst_filename
+        # -p makes qemu-img write "(12.34/100%)" to its log as it goes. rebase -u doesn't copy anything.
+        cmd = re.sub("qemu-img (convert|commit|rebase) (?!-u)", "qemu-img \\1 -p ", cmd)
+        # Wrap the job so we know its PID and exit code. The job runs under nohup so it survives if we
+        # lose the connection. The wrapper prints the PID, then the last progress qemu-img logged every
+        # PROGRESS_INTERVAL seconds, one per line, until the job is done. Then it exits with the exit
+        # code of the job, so the channel stays open until the job is done. The exit code is also
+        # written to CVM_JOB_DIR/<output>.rc in case the channel goes away. See conversion_jobs.
+        cmd = "mkdir -p " + CVM_JOB_DIR + "; rm -f " + job_file + ".rc; " + \
+              "nohup sh -c '" + cmd + " > " + job_file + ".log 2>&1; rc=$?; echo $rc > " + job_file + ".rc; " + \
+              "[ $rc -eq 0 ] && rm -f " + job_file + ".log' > /dev/null 2>&1 & " + \
+              "pid=$!; echo $pid; while [ ! -s " + job_file + ".rc ] && kill -0 $pid 2> /dev/null; do " + \
+              "sleep " + str(PROGRESS_INTERVAL) + "; tail -c 256 " + job_file + ".log 2> /dev/null | tr '\\r' '\\n' | " + \
+              "grep '/100%)' | tail -1; done; wait $pid; exit $(cat " + job_file + ".rc 2> /dev/null || echo 255)"
         
         print("IN SSH CMD:",cmd)
-        # These return values are useless because we CMD runs in the background.
-        # If we need to debug, we can remove the "&" at the end of CMD.
+        # The first line of stdout is the PID of the job, followed by its progress. The exit status of
+        # the channel is the exit code of qemu-img.
         stdin, stdout, stderr = ssh.exec_command(cmd)
         return(stdin,stdout,stderr)
 
+    # Return the exit code of the conversion job for filename on cvm_ip, or None if it's still running.
+    def job_exit_status(self,cvm_ip,pwd,filename):
+
+        ssh = self.get_ssh(cvm_ip,pwd)
+        stdin, stdout, stderr = ssh.exec_command("cat " + CVM_JOB_DIR + "/" + filename + ".rc")
+        rc_str = stdout.read().decode().strip()
+        if rc_str == "":
+            return None
+        return int(rc_str)
+
+    # Return True if the wrapper of the conversion job for filename, with PID pid, still runs on cvm_ip.
+    # The PID has to still be our wrapper for filename, since the CVM may have rebooted in the meantime.
+    def job_running(self,cvm_ip,pwd,filename,pid):
+
+        ssh = self.get_ssh(cvm_ip,pwd)
+        stdin, stdout, stderr = ssh.exec_command("ps -o args= -p " + pid + " | grep -q " + CVM_JOB_DIR + "/" + filename + ".rc")
+        return stdout.channel.recv_exit_status() == 0
+
+    # Return what "qemu-img info" says about filename in container, as a dict. Among other things it
+    # has the virtual-size of the disk and the actual-size it takes up. Return None if that fails.
+    def image_info(self,cvm_ip,pwd,container,filename):
+
+        cmd = "/usr/local/nutanix/bin/qemu-img info --output=json nfs://127.0.0.1/" + container + "/" + filename
+        try:
+            ssh = self.get_ssh(cvm_ip,pwd)
+            stdin, stdout, stderr = ssh.exec_command(cmd)
+            return json.loads(stdout.read().decode())
+        except Exception:
+            return None
+
+    # Create an empty (sparse) raw disk of size bytes as filename in container, for the shards of a
+    # disk to be converted into. Any CVM in cvm_ip_list will do. Return True if qemu-img could.
+    def create_raw(self,cvm_ip_list,pwd,container,filename,size):
+
+        cmd = "/usr/local/nutanix/bin/qemu-img create -f raw nfs://127.0.0.1/" + container + "/" + filename + " " + str(size)
+        for cvm_ip in cvm_ip_list:
+            try:
+                ssh = self.get_ssh(cvm_ip,pwd)
+                stdin, stdout, stderr = ssh.exec_command(cmd)
+                if stdout.channel.recv_exit_status() == 0:
+                    return True
+                print("Could not create %s in %s: %s" % (filename, container, stderr.read().decode()))
+                return False
+            except Exception as ex:
+                print("Could not create %s on %s: %s" % (filename, cvm_ip, ex))
+        return False
+
+    # Return how busy cvm_ip is, as a dict with its 1 minute load average, number of cores, the % of
+    # CPU time the hypervisor stole and the average ms its disks took per I/O, over interval seconds.
+    # Return None if we can't tell.
+    def cvm_load(self,cvm_ip,pwd,interval=2):
+
+        try:
+            ssh = self.get_ssh(cvm_ip,pwd)
+            cmd = "cat /proc/loadavg; nproc; head -1 /proc/stat; cat /proc/diskstats; sleep " + str(interval) + \
+                  "; head -1 /proc/stat; cat /proc/diskstats"
+            stdin, stdout, stderr = ssh.exec_command(cmd)
+            lines = stdout.read().decode().splitlines()
+            load = float(lines[0].split()[0])
+            cores = int(lines[1])
+        except Exception as ex:
+            print("Could not tell how busy %s is: %s" % (cvm_ip, ex))
+            return None
+        # Each sample is the cpu line of /proc/stat, followed by /proc/diskstats.
+        samples = []
+        for line in lines[2:]:
+            fields = line.split()
+            if len(fields) > 0 and fields[0] == "cpu":
+                samples.append({"cpu": [int(x) for x in fields[1:9]], "ios": 0, "ms": 0})
+            # Only whole disks: major minor name reads merged sectors ms_reading writes merged sectors ms_writing
+            elif len(samples) > 0 and len(fields) > 10 and re.match(r"^(sd[a-z]+|vd[a-z]+|nvme\d+n\d+)$", fields[2]):
+                samples[-1]["ios"] += int(fields[3]) + int(fields[7])
+                samples[-1]["ms"] += int(fields[6]) + int(fields[10])
+        if len(samples) != 2:
+            return None
+        cpu = [b - a for a, b in zip(samples[0]["cpu"], samples[1]["cpu"])]
+        ios = samples[1]["ios"] - samples[0]["ios"]
+        return {"load": load, "cores": max(cores, 1), "steal": 100.0 * cpu[7] / max(sum(cpu), 1), \
+                "latency": float(samples[1]["ms"] - samples[0]["ms"]) / ios if ios > 0 else 0.0}
+
+    # Return the last few lines of output of a conversion job that failed.
+    def job_log(self,cvm_ip,pwd,filename):
+
+        try:
+            ssh = self.get_ssh(cvm_ip,pwd)
+            # Leave out the progress qemu-img -p wrote.
+            stdin, stdout, stderr = ssh.exec_command("tr '\\r' '\\n' < " + CVM_JOB_DIR + "/" + filename + ".log | " + \
+                                                     "grep -v '/100%)' | tail -5")
+            return stdout.read().decode()
+        except Exception as ex:
+            return "Could not read the log on %s: %s" % (cvm_ip, ex)
+
+    # Return True if cvm_ip answers over ssh.
+    def cvm_alive(self,cvm_ip,pwd):
+
+        try:
+            ssh = self.get_ssh(cvm_ip,pwd)
+            stdin, stdout, stderr = ssh.exec_command("true", timeout=30)
+            return stdout.channel.recv_exit_status() == 0
+        except Exception:
+            return False
+
+    # Stop the conversion job for filename with PID pid on cvm_ip, if it is still running there. The
+    # PID has to still be our wrapper for filename, since the CVM may have rebooted in the meantime.
+    # filename is what the job files in CVM_JOB_DIR are named after. See ssh_cmd().
+    def kill_job(self,cvm_ip,pwd,filename,pid):
+
+        job_file = CVM_JOB_DIR + "/" + filename
+        cmd = "if ps -o args= -p " + pid + " | grep -q " + job_file + ".rc; then pkill -P " + pid + "; kill " + pid + "; fi"
+        try:
+            ssh = self.get_ssh(cvm_ip,pwd)
+            stdin, stdout, stderr = ssh.exec_command(cmd)
+            stdout.channel.recv_exit_status()
+        except Exception as ex:
+            print("Could not stop %s on %s: %s" % (filename, cvm_ip, ex))
+
+    # Same as kill_job(), but from peer_ip, another CVM of the cluster, for when we can't reach cvm_ip
+    # ourselves. The CVMs ssh to each other as nutanix without a password. Return True if cvm_ip
+    # answered peer_ip, and the job doesn't run there anymore.
+    def kill_job_from(self,peer_ip,pwd,cvm_ip,filename,pid):
+
+        running = "ps -o args= -p " + pid + " | grep -q " + CVM_JOB_DIR + "/" + filename + ".rc"
+        cmd = "ssh -o ConnectTimeout=30 -o BatchMode=yes -o StrictHostKeyChecking=no nutanix@" + cvm_ip + \
+              " '" + running + " && { pkill -P " + pid + "; kill " + pid + "; sleep 5; }; ! " + running + "'"
+        try:
+            ssh = self.get_ssh(peer_ip,pwd)
+            stdin, stdout, stderr = ssh.exec_command(cmd, timeout=120)
+            return stdout.channel.recv_exit_status() == 0
+        except Exception as ex:
+            print("Could not stop %s on %s from %s: %s" % (filename, cvm_ip, peer_ip, ex))
+            return False
+
     # Take the CSV filename. Return VM Names in it.
     def get_important_vms(self,csvfile):
         
@@ -178,45 +1415,20 @@ class my_api():
         print("Response code: ",server_response.status_code)
         return server_response.status_code ,json.loads(server_response.text)
         
-    # We have to use the v1 API because thats the only way we can figure out if
-    # its a controller VM.
+    # Every host lists the IP of its controller VM, so ask the hosts endpoint. That's one entry
+    # per node, instead of going through the list of every VM on the cluster.
     # Return a list of CVM IPs.
     def get_cvms(self):
-        cluster_url = self.base_urlv1 + "vms/"
-        server_response = self.sessionv1.get(cluster_url)
+        cluster_url = self.base_urlv2 + "hosts/"
+        status, all_hosts = self.get_paged(cluster_url)
         
-        all_vms = json.loads(server_response.text)
-        all_vms_list = all_vms["entities"]
         cvm_list=[]
-        for v in all_vms_list:
-            if (v["controllerVm"] == True):
-                cvm_list.append(v["ipAddresses"][0])
-        # print("Response code: ",server_response.status_code)
+        for h in all_hosts:
+            if h.get("service_vmexternal_ip"):
+                cvm_list.append(h["service_vmexternal_ip"])
+        # print("Response code: ",status)
         return cvm_list
 
-    # SSH into a CVM and return the number of qemu-img convert jobs that are running.
-    def check_jobs(self,cvm_ip,pwd):
-        
-        ssh = paramiko.SSHClient()
-        ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        try:
-            ssh.connect(cvm_ip, username="nutanix", password=pwd)
-        except Exception as ex:
-            print("Could not connect to:",cvm_ip)
-            print(ex)
-            sys.exit(1)
-
-        cmd = "ps -elf | grep qemu-img | grep -v grep"
-
-        # print("IN CHECK JOBS CMD:",cmd)
-        stdin, stdout, stderr = ssh.exec_command(cmd)
-        mystr = stdout.read()
-        nlines = mystr.count(bytes('\n','utf-8'))
-        
-        return nlines
-
     # Get network info so we get new network UUID.
     def get_network_info(self):
     
@@ -236,8 +1448,29 @@ class my_api():
         # print("Response code: %s" % server_response.status_code)
         return server_response.status_code ,json.loads(server_response.text)
     
+    # Wait up to timeout seconds for the task with task_uuid to finish. Return its progress_status,
+    # like "Succeeded" or "Failed", or None if we can't tell.
+    def wait_for_task(self,task_uuid,timeout=300):
+
+        cluster_url = self.base_urlv2 + "tasks/" + str(quote(task_uuid))
+        deadline = time.time() + timeout
+        while True:
+            try:
+                server_response = self.sessionv2.get(cluster_url)
+                task = json.loads(server_response.text)
+            except Exception as ex:
+                print(ex)
+                return None
+            if server_response.status_code != 200:
+                print("Could not get task %s. Response code: %s" % (task_uuid, server_response.status_code))
+                return None
+            progress_status = task.get("progress_status")
+            if progress_status not in ["Queued", "Running"] or time.time() > deadline:
+                return progress_status
+            time.sleep(5)
     
     # Take the list of files in DIR and return names and UUIDs from config files.
+    # Only needed for exports that didn't write a manifest. See load_manifest().
     def get_vmnameanduuid(self,files):
         
         uuid_regex = "[a-z0-9-]+"
@@ -245,7 +1478,7 @@ class my_api():
     
         for f in files:
             # If its a config file.
-            cfg_regex = "(" + uuid_regex + ").cfg"
+            cfg_regex = "(" + uuid_regex + ")\\.cfg$"
             matchObj = re.match(cfg_regex,f)
             if matchObj:
                 # print ("matchobj group(0) %s" % matchObj.group(0))
@@ -253,16 +1486,12 @@ class my_api():
                 
                 # If the config file looks like a UUID, read it.
                 vmcfg_fp = open(DIR + "/" + vm_uuid + ".cfg", "r")
-                vm_json = vmcfg_fp.read()
-                vmcfg_fp.close()
-                
-                name_regex = '"name": "([^"]+)"'
-                matchObj1 = re.search(name_regex,vm_json)
-                if matchObj1:
-                    vm_name = matchObj1.group(1)
-                else:
+                try:
+                    vm_name = json.load(vmcfg_fp)["name"]
+                except (ValueError, KeyError):
                     print ("Could not find %s in %s. This should not happen." %(vm_uuid,f))
                     sys.exit(1)
+                vmcfg_fp.close()
                 vmname_byuuid[vm_uuid] = vm_name
         return vmname_byuuid
 
@@ -312,3 +1541,1010 @@ class my_api():
         #print("LEAVING SFTP_LS", size, filepath)
         return size
 
+    # Before we resume a transfer at offset, make sure the bytes just before offset are the same
+    # on both sides. Otherwise we'd be appending to a file that got mangled on the way. We only read
+    # nbytes from the sftp server, so a short paramiko session is fine here.
+    # Return True if the sha256 of the overlapping tail matches, False otherwise.
+    def sftp_tail_matches(self,remotepath,localpath,offset,nbytes=1048576):
+
+        start = max(0, offset - nbytes)
+        try:
+            transport = paramiko.Transport((self.ip_addr, 2222))
+            transport.connect(username=self.username, password=self.password)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            rfp = sftp.open(remotepath, "rb")
+            rfp.seek(start)
+            remote_tail = rfp.read(offset - start)
+            rfp.close()
+            sftp.close()
+            transport.close()
+
+            lfp = open(localpath, "rb")
+            lfp.seek(start)
+            local_tail = lfp.read(offset - start)
+            lfp.close()
+        except Exception as ex:
+            print("Could not compare tail of %s and %s." % (remotepath, localpath))
+            print(ex)
+            return False
+
+        if len(remote_tail) != (offset - start) or len(local_tail) != (offset - start):
+            return False
+        return hashlib.sha256(remote_tail).hexdigest() == hashlib.sha256(local_tail).hexdigest()
+
+    # Ask the sftp server on the CVM for the sha256 of every block_size bytes of remotepath
+    # (the check-file extension of sftp). The server reads the file, not us.
+    # Return them as a list of hex strings, or None if the server can't do it.
+    def sftp_block_hashes(self,remotepath,block_size):
+
+        try:
+            transport = paramiko.Transport((self.ip_addr, 2222))
+            transport.connect(username=self.username, password=self.password)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            rfp = sftp.open(remotepath, "rb")
+            sums = rfp.check("sha256", 0, 0, block_size)
+            rfp.close()
+            sftp.close()
+            transport.close()
+        except Exception as ex:
+            print("The sftp server could not checksum %s: %s" % (remotepath, ex))
+            return None
+        return [sums[i:i + 32].hex() for i in range(0, len(sums), 32)]
+
+    # Check remotepath on the CVM against checksum, which a stream_checksum returned for our copy.
+    # Print both checksums and how long the check took.
+    # Return True if they match, False if they don't, None if the CVM couldn't tell us.
+    def verify_checksum(self,remotepath,checksum):
+
+        start_time = time.time()
+        blocks = self.sftp_block_hashes(remotepath, checksum["block_size"])
+        runtime = time.time() - start_time
+        if blocks is None:
+            print("Could not check %s on %s. Local sha256: %s" % (remotepath, self.ip_addr, checksum["sha256"]))
+            return None
+        print("%s sha256 local: %s, on %s: %s. Checked in %0.1f seconds." \
+              % (remotepath, checksum["sha256"], self.ip_addr, blocks_sha256(blocks), runtime))
+        if blocks == checksum["blocks"]:
+            return True
+        for i in range(min(len(blocks), len(checksum["blocks"]))):
+            if blocks[i] != checksum["blocks"][i]:
+                print(">>> %s differs from our copy at byte %d. <<<" % (remotepath, i * checksum["block_size"]))
+                break
+        return False
+
+# With CONVERSION_CACHE, the record of each qcow2 file in EXPORTCONTAINER is <file>.qcow2.cache.
+# Deltas (see DELTA_SUFFIX) are never cached, since they depend on the file they are based on.
+CACHE_SUFFIX=".cache"
+
+# The qemu-img options the export converts a vdisk with. See my_api.ssh_cmd().
+def conversion_options():
+    return " ".join(COMPRESS.split())
+
+# What a cached file must have been converted from for a disk to use it. vdisk_uuid is the vmdisk_uuid
+# of the disk, and size is the size of the vdisk in bytes.
+def cache_key(vdisk_uuid,vm_logical_timestamp,size):
+    return {"vdisk_uuid": vdisk_uuid, "vm_logical_timestamp": str(vm_logical_timestamp), "size": size, \
+            "options": conversion_options()}
+
+# Return how many more bytes container, an entity from GET /storage_containers, has room for.
+# Return None if Prism doesn't tell us.
+def container_free_bytes(container):
+    usage = container.get("usage_stats", {})
+    for key in ["storage.user_free_bytes", "storage.free_bytes"]:
+        try:
+            return int(usage[key])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return None
+
+# The cached qcow2 files in container on the source cluster, and their records. We list the container
+# and read every record once when we start. A record is written back whenever its file is converted
+# or used, so make_room() knows which files went unused the longest. Files without a record, like
+# deltas or files from before we had a cache, are never removed. All of this goes over one sftp
+# session, which we open the first time we need it and keep until close().
+class conversion_cache():
+    def __init__(self,mycluster,container):
+
+        self.mycluster = mycluster
+        self.container = container
+        self.lock = threading.Lock()
+        # Size of every file in the container, and the record of every cached file.
+        self.sizes = {}
+        self.records = {}
+
+        def load(sftp):
+            for attr in sftp.listdir_attr("/" + container):
+                self.sizes[attr.filename] = attr.st_size
+            for name in self.sizes:
+                if not name.endswith(CACHE_SUFFIX):
+                    continue
+                try:
+                    fp = sftp.open("/" + container + "/" + name, "r")
+                    self.records[name[:-len(CACHE_SUFFIX)]] = json.loads(fp.read().decode())
+                    fp.close()
+                except (IOError, ValueError) as ex:
+                    print("Could not read %s: %s" % (name, ex))
+            return True
+        if self.with_sftp(load) is None:
+            print("Could not read the conversion cache in %s. Converting everything." % container)
+        print("%d cached files in %s. %0.2f GB." % (len(self.records), container, \
+              sum([record.get("bytes", 0) for record in self.records.values()]) / 1073741824))
+
+    # Run fn(sftp) in the sftp session of mycluster. Return what it returns, or None if that fails.
+    def with_sftp(self,fn):
+
+        return self.mycluster.with_sftp(fn)
+
+    def write(self,filename,record):
+
+        def put(sftp):
+            fp = sftp.open("/" + self.container + "/" + filename + CACHE_SUFFIX, "w")
+            fp.write(json.dumps(record))
+            fp.close()
+            return True
+        return self.with_sftp(put)
+
+    # Return the record of filename if it was converted from what key says, and is still all there.
+    # Return None otherwise. Then the record goes, since filename is about to be converted again.
+    def lookup(self,filename,key):
+
+        with self.lock:
+            record = self.records.get(filename)
+        if record is None:
+            return None
+        changed = [k for k in key if record.get(k) != key[k]]
+        if self.sizes.get(filename) != record.get("bytes"):
+            changed.append("bytes")
+        if len(changed) > 0:
+            print("Cached %s does not match: %s. Converting it again." % (filename, ", ".join(changed)))
+            self.forget(filename)
+            return None
+        record["used"] = time.time()
+        self.write(filename, record)
+        return record
+
+    # filename was just converted from what key says.
+    def store(self,filename,key):
+
+        def stat(sftp):
+            return sftp.stat("/" + self.container + "/" + filename).st_size
+        size = self.with_sftp(stat)
+        if size is None:
+            return
+        record = dict(key)
+        record["bytes"] = size
+        record["converted"] = record["used"] = time.time()
+        if self.write(filename, record) is not None:
+            with self.lock:
+                self.sizes[filename] = size
+                self.records[filename] = record
+
+    # Drop the record of filename, but leave the file.
+    def forget(self,filename):
+
+        with self.lock:
+            self.records.pop(filename, None)
+        self.with_sftp(lambda sftp: sftp.remove("/" + self.container + "/" + filename + CACHE_SUFFIX))
+
+    # Remove filename and its record. Return True if the file is gone.
+    def remove(self,filename):
+
+        self.forget(filename)
+        if self.with_sftp(lambda sftp: sftp.remove("/" + self.container + "/" + filename) or True) is None:
+            return False
+        with self.lock:
+            self.sizes.pop(filename, None)
+        return True
+
+    # Conversions that write up to needed bytes are coming, and the container has room for free bytes
+    # (None if we don't know). Remove cached files that are not in keep, least recently used first,
+    # until there is room for them, and the cache is no bigger than CACHE_MAX_GB.
+    def make_room(self,needed,free,keep):
+
+        with self.lock:
+            records = dict(self.records)
+        cached = sum([record.get("bytes", 0) for record in records.values()])
+        for filename in sorted(records, key=lambda f: records[f].get("used", 0)):
+            short = free is not None and free < needed
+            over = CACHE_MAX_GB > 0 and cached > CACHE_MAX_GB * 1073741824
+            if not short and not over:
+                break
+            if filename in keep:
+                continue
+            nbytes = records[filename].get("bytes", 0)
+            print("Removing cached %s from %s to make room. %0.2f GB, last used %s." \
+                  % (filename, self.container, nbytes / 1073741824, \
+                     time.strftime("%Y-%m-%d %H:%M", time.localtime(records[filename].get("used", 0)))))
+            if self.remove(filename):
+                cached -= nbytes
+                if free is not None:
+                    free += nbytes
+        if free is not None and free < needed:
+            print(">>> %s may not have room for this export. %0.2f GB free, up to %0.2f GB needed. <<<" \
+                  % (self.container, free / 1073741824, needed / 1073741824))
+
+# How often the wrapper of a conversion job sends us its progress, in seconds. See my_api.ssh_cmd().
+PROGRESS_INTERVAL=5
+# How often cvm_admission looks at each CVM, in seconds.
+CVM_SAMPLE_INTERVAL=30
+# sshd on the CVMs allows this many channels per connection. Every running job keeps one open on the
+# connection my_api pools for its CVM, and we need a couple more for everything else.
+SSH_MAX_SESSIONS=10
+
+# A job whose CVM stopped answering counts as lost after CVM_FAILOVER_TIMEOUT seconds. A job that
+# failed or was lost on a CVM that doesn't answer is moved to another CVM, up to CONVERSION_RETRIES
+# times. A CVM that doesn't answer gets no new jobs, and is asked again every CVM_PROBE_INTERVAL
+# seconds. If no CVM answers for CVM_GIVE_UP seconds, the disks still waiting fail.
+# The old job may still be running on a CVM we can't reach, so two CVMs must never write the same file.
+# A job that makes a file writes it as <file>.<CVM IP>-<attempt>.part, and it is renamed to <file> once
+# the job is done. A job that writes into a file that is already there (a shard or a delta on the
+# destination cluster) is only moved once another CVM made sure it stopped. See conversion_jobs.
+CVM_FAILOVER_TIMEOUT=300
+CONVERSION_RETRIES=2
+CVM_PROBE_INTERVAL=60
+CVM_GIVE_UP=1800
+PART_SUFFIX=".part"
+
+# Return True if the conversion of filename writes into a file that is already there, instead of
+# making its own. nfs_path and byte_range are the same as for my_api.ssh_cmd().
+def writes_in_place(filename,nfs_path,byte_range):
+    return nfs_path == None and (byte_range != None or filename.endswith(DELTA_SUFFIX))
+
+# Return the file the conversion of filename writes. See my_api.ssh_cmd().
+def job_output(filename,nfs_path,byte_range):
+    if nfs_path != None:
+        return filename
+    if byte_range != None:
+        return re.sub(".qcow2$", ".raw", shard_of(filename))
+    if filename.endswith(DELTA_SUFFIX):
+        return re.sub(".qcow2$", ".raw", delta_base(filename))
+    return re.sub(".qcow2", ".raw", filename)
+
+# Decides how many conversion jobs each CVM may run. With ADAPTIVE_CVM_JOBS, a thread samples every CVM
+# over its pooled ssh connection (my_api.cvm_load) every CVM_SAMPLE_INTERVAL seconds. A busy CVM gets
+# half as many jobs, a quiet one gets one more, between MIN_CVM_JOBS and MAX_CVM_JOBS.
+class cvm_admission():
+    def __init__(self,mycluster,pwd):
+
+        self.mycluster = mycluster
+        self.pwd = pwd
+        self.lock = threading.Lock()
+        self.high = max(1, min(MAX_CVM_JOBS, SSH_MAX_SESSIONS - 2))
+        self.low = max(1, min(MIN_CVM_JOBS, self.high))
+        # Start with all we may run, like without ADAPTIVE_CVM_JOBS, and back off from there.
+        self.start_limit = self.high
+        self.limits = {}
+        self.stop = threading.Event()
+        self.thread = None
+
+    # Return how many jobs cvm_ip may run right now. Never more than the pooled ssh connection has
+    # channels for, even without ADAPTIVE_CVM_JOBS.
+    def limit(self,cvm_ip):
+
+        if ADAPTIVE_CVM_JOBS == False:
+            return self.high
+        with self.lock:
+            return self.limits.setdefault(cvm_ip, self.start_limit)
+
+    # Sample the CVMs in cvm_ip_list, except the ones in skip while they are in it.
+    def start(self,cvm_ip_list,skip=None):
+
+        if ADAPTIVE_CVM_JOBS == False or self.thread is not None:
+            return
+        if skip is None:
+            skip = {}
+        self.stop.clear()
+        self.thread = threading.Thread(target=self.run, args=(list(cvm_ip_list),skip), daemon=True)
+        self.thread.start()
+
+    def close(self):
+
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self,cvm_ip_list,skip):
+
+        while True:
+            for cvm_ip in cvm_ip_list:
+                if self.stop.is_set():
+                    return
+                if cvm_ip not in skip:
+                    self.sample(cvm_ip)
+            if self.stop.wait(CVM_SAMPLE_INTERVAL):
+                return
+
+    # Look at how busy cvm_ip is, and give it fewer or more jobs.
+    def sample(self,cvm_ip):
+
+        stats = self.mycluster.cvm_load(cvm_ip, self.pwd)
+        if stats is None:
+            return
+        busy = []
+        if stats["load"] / stats["cores"] > CVM_BUSY_LOAD:
+            busy.append("load %0.1f on %d cores" % (stats["load"], stats["cores"]))
+        if stats["steal"] > CVM_BUSY_STEAL:
+            busy.append("%0.1f%% steal" % stats["steal"])
+        if stats["latency"] > CVM_BUSY_LATENCY:
+            busy.append("%0.1f ms disk latency" % stats["latency"])
+        with self.lock:
+            old = self.limits.setdefault(cvm_ip, self.start_limit)
+            if len(busy) > 0:
+                new = max(self.low, old // 2)
+            else:
+                new = min(self.high, old + 1)
+            self.limits[cvm_ip] = new
+        if new < old:
+            print("%s is busy (%s). %d conversion jobs at a time, down from %d." % (cvm_ip, ", ".join(busy), new, old))
+        elif new > old:
+            print("%s is quiet. %d conversion jobs at a time, up from %d." % (cvm_ip, new, old))
+
+# Keeps track of the qemu-img convert jobs we started, so we know their PID and exit code instead of
+# counting qemu-img processes with ps. my_api.ssh_cmd() keeps the channel of every job open until the
+# job is done. A thread per job waits on that channel and pushes the job onto self.completed the
+# moment it finishes, so the scripts don't have to poll the CVMs.
+# A CVM we can't reach is marked unhealthy, and its jobs go to the other CVMs until it answers again.
+# Return what the job files of job in CVM_JOB_DIR are named after. See my_api.ssh_cmd().
+def job_name(job):
+    return job["filename"] if job["part"] is None else job["part"]
+
+# Return the container job writes to.
+def job_container(job):
+    return EXPORTCONTAINER if job["nfs_path"] != None else SFTPCONTAINER
+
+class conversion_jobs():
+    def __init__(self,mycluster,pwd):
+
+        self.mycluster = mycluster
+        self.pwd = pwd
+        # Key is the filename we are converting to. Value is a dict with the CVM IP, PID, status,
+        # exit code, start and end time of the job.
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.completed = queue.Queue()
+        self.admission = cvm_admission(mycluster,pwd)
+        # CVMs that don't answer, and when we last asked them.
+        self.unhealthy = {}
+        # Jobs we moved off a CVM that may still be running there, and how often each file was started.
+        self.moved = []
+        self.attempts = {}
+        self.cvm_ip_list = []
+
+    # Convert filename on cvm_ip. nfs_path is the source vdisk on the source cluster and None on
+    # the destination cluster, and byte_range is set for a shard, same as my_api.ssh_cmd().
+    # size is the size of the source disk in bytes, which we use to spread the work.
+    # Unless it writes in place, the job writes a file of its own, named after cvm_ip and the attempt.
+    # See PART_SUFFIX.
+    # Return the job, or None if we couldn't start it on cvm_ip.
+    def start(self,cvm_ip,filename,nfs_path,size=0,byte_range=None):
+
+        output = job_output(filename,nfs_path,byte_range)
+        part = None
+        if not writes_in_place(filename,nfs_path,byte_range):
+            with self.lock:
+                part = "%s.%s-%d%s" % (output, cvm_ip, self.attempts.get(filename, 0) + 1, PART_SUFFIX)
+        try:
+            stdin, stdout, stderr = self.mycluster.ssh_cmd(cvm_ip,self.pwd,filename,nfs_path,byte_range,part)
+            pid = stdout.readline().strip()
+        except Exception as ex:
+            print("Could not start conversion of %s on %s: %s" % (filename, cvm_ip, ex))
+            return None
+        if pid == "":
+            print("Could not start conversion of %s on %s." % (filename, cvm_ip))
+            return None
+        job = {"filename": filename, "cvm_ip": cvm_ip, "pid": pid, "size": size, "nfs_path": nfs_path, \
+               "byte_range": byte_range, "status": "running", "rc": None, "start_time": time.time(), \
+               "end_time": None, "log": "", "percent": 0.0, "rate": None, "eta": None, "lost": False, \
+               "output": output, "part": part}
+        with self.lock:
+            self.jobs[filename] = job
+            self.attempts[filename] = self.attempts.get(filename, 0) + 1
+        print("Started conversion of %s on %s. PID: %s." % (filename, cvm_ip, pid))
+        t = threading.Thread(target=self.watch, args=(job,stdout), daemon=True)
+        t.start()
+        return job
+
+    # Wait for the job to finish and record how it went.
+    # Until then, read the progress my_api.ssh_cmd() sends us, and work out how fast the job goes and
+    # when it will be done.
+    def watch(self,job,stdout):
+
+        try:
+            for line in iter(stdout.readline, ""):
+                matchObj = re.search(r"\((\d+\.?\d*)/100%\)", line)
+                if matchObj:
+                    self.update_progress(job, float(matchObj.group(1)))
+        except Exception as ex:
+            print("Lost track of %s on %s: %s" % (job["filename"], job["cvm_ip"], ex))
+        rc = stdout.channel.recv_exit_status()
+        # -1 means the channel went away before the job finished. The job itself keeps running under
+        # nohup, so keep reading its .rc file until it shows up. If the CVM doesn't answer for
+        # CVM_FAILOVER_TIMEOUT seconds, or answers but the wrapper is gone without writing its .rc
+        # file (a reboot or the OOM killer took it), the job is lost.
+        name = job_name(job)
+        lost_since = None
+        unreachable = False
+        while rc == -1:
+            time.sleep(30)
+            try:
+                rc = self.mycluster.job_exit_status(job["cvm_ip"],self.pwd,name)
+                if rc is None and not self.mycluster.job_running(job["cvm_ip"],self.pwd,name,job["pid"]):
+                    # The wrapper may have written its .rc file just before it exited.
+                    rc = self.mycluster.job_exit_status(job["cvm_ip"],self.pwd,name)
+                    if rc is None:
+                        print("Lost %s on %s: PID %s is gone." % (job["filename"], job["cvm_ip"], job["pid"]))
+                        job["lost"] = True
+                        rc = -1
+                        break
+                lost_since = None
+            except Exception as ex:
+                rc = None
+                if lost_since is None:
+                    lost_since = time.time()
+                elif time.time() - lost_since > CVM_FAILOVER_TIMEOUT:
+                    print("Lost %s on %s: %s" % (job["filename"], job["cvm_ip"], ex))
+                    job["lost"] = True
+                    unreachable = True
+                    rc = -1
+                    break
+            if rc is None:
+                rc = -1
+        if rc == 0 and job["part"] is not None:
+            if not self.mycluster.sftp_rename(job_container(job),job["part"],job["output"]):
+                print("Could not rename %s to %s." % (job["part"], job["output"]))
+                rc = 1
+        if rc != 0:
+            job["log"] = self.mycluster.job_log(job["cvm_ip"],self.pwd,name)
+            # Unless the job may still be running on a CVM that doesn't answer, its file is no use.
+            # See probe_unhealthy() for the others.
+            if job["part"] is not None and not unreachable:
+                self.mycluster.sftp_delete(job_container(job),job["part"])
+        with self.lock:
+            job["rc"] = rc
+            job["end_time"] = time.time()
+            job["status"] = "done" if rc == 0 else "failed"
+        self.completed.put(job)
+
+    # job is percent done. qemu-img counts the bytes of the disk it went through, so the job has gone
+    # through that much of job["size"].
+    def update_progress(self,job,percent):
+
+        elapsed = max(time.time() - job["start_time"], 1)
+        done = job["size"] * percent / 100
+        with self.lock:
+            job["percent"] = percent
+            job["rate"] = done / elapsed
+            job["eta"] = (job["size"] - done) / job["rate"] if job["rate"] > 0 else None
+
+    # Print how far along each running job is.
+    def show_progress(self):
+
+        with self.lock:
+            running = [dict(job) for job in self.jobs.values() if job["status"] == "running"]
+        for job in sorted(running, key=lambda j: j["start_time"]):
+            eta = "unknown" if job["eta"] is None else "%d seconds" % job["eta"]
+            print("    %s on %s: %0.1f%% of %0.2f GB. %0.2f MB/s. ETA: %s." \
+                  % (job["filename"], job["cvm_ip"], job["percent"], job["size"] / 1073741824, \
+                     (job["rate"] or 0) / 1048576, eta))
+
+    def mark_unhealthy(self,cvm_ip):
+
+        with self.lock:
+            if cvm_ip in self.unhealthy:
+                return
+            self.unhealthy[cvm_ip] = time.time()
+        print(">>> %s does not answer. Not giving it any more conversion jobs for now. <<<" % cvm_ip)
+
+    # Ask the CVMs that didn't answer again, once every CVM_PROBE_INTERVAL seconds. Take back the ones
+    # that answer, after stopping the jobs we moved off them in case those are still running there.
+    def probe_unhealthy(self):
+
+        with self.lock:
+            due = [c for c, t in self.unhealthy.items() if time.time() - t >= CVM_PROBE_INTERVAL]
+        for cvm_ip in due:
+            if not self.mycluster.cvm_alive(cvm_ip,self.pwd):
+                with self.lock:
+                    self.unhealthy[cvm_ip] = time.time()
+                continue
+            with self.lock:
+                moved = [job for job in self.moved if job["cvm_ip"] == cvm_ip]
+                self.moved = [job for job in self.moved if job["cvm_ip"] != cvm_ip]
+            for job in moved:
+                self.mycluster.kill_job(cvm_ip,self.pwd,job_name(job),job["pid"])
+                if job["part"] is not None:
+                    self.mycluster.sftp_delete(job_container(job),job["part"])
+            with self.lock:
+                del self.unhealthy[cvm_ip]
+            print("%s answers again. Giving it conversion jobs." % cvm_ip)
+
+    # job failed. If its CVM doesn't answer, or the job died with the wrapper, it wasn't the disk, so it
+    # should run again on another CVM, unless it ran CONVERSION_RETRIES times already. Return True if it should.
+    # A job that writes in place may still be running on a CVM that doesn't answer, and only moves
+    # once another CVM made sure it stopped. Any other job writes a file of its own, so it can move.
+    def should_move(self,job):
+
+        with self.lock:
+            attempts = self.attempts.get(job["filename"], 0)
+        if attempts > CONVERSION_RETRIES:
+            return False
+        if job["cvm_ip"] in self.unhealthy or not self.mycluster.cvm_alive(job["cvm_ip"],self.pwd):
+            self.mark_unhealthy(job["cvm_ip"])
+            if job["part"] is None and not self.stop_from_peer(job):
+                print(">>> Not moving %s: it writes into %s in place, and it may still run on %s. <<<" \
+                      % (job["filename"], job["output"], job["cvm_ip"]))
+                return False
+            with self.lock:
+                self.moved.append(job)
+        elif job["lost"] == False:
+            return False
+        print("Moving %s from %s to another CVM." % (job["filename"], job["cvm_ip"]))
+        return True
+
+    # Stop job on its CVM from one of the other CVMs that answer us. Return True if one of them could.
+    def stop_from_peer(self,job):
+
+        with self.lock:
+            peers = [c for c in self.cvm_ip_list if c != job["cvm_ip"] and c not in self.unhealthy]
+        for peer_ip in peers:
+            if self.mycluster.kill_job_from(peer_ip,self.pwd,job["cvm_ip"],job_name(job),job["pid"]):
+                print("Stopped %s on %s from %s." % (job["filename"], job["cvm_ip"], peer_ip))
+                return True
+        return False
+
+    # Give up on a disk no CVM could take.
+    def give_up(self,filename,size,on_done):
+
+        job = {"filename": filename, "cvm_ip": None, "pid": "", "size": size, "nfs_path": None, \
+               "byte_range": None, "status": "failed", "rc": -1, "start_time": time.time(), \
+               "end_time": time.time(), "log": "No CVM answered.", "percent": 0.0, "rate": None, "eta": None, \
+               "lost": False, "output": filename, "part": None}
+        with self.lock:
+            self.jobs[filename] = job
+        if on_done is not None:
+            on_done(job)
+
+    # Return the number of our jobs that are still running, on cvm_ip or on all CVMs.
+    def running(self,cvm_ip=None):
+
+        with self.lock:
+            return len([job for job in self.jobs.values() \
+                        if job["status"] == "running" and (cvm_ip is None or job["cvm_ip"] == cvm_ip)])
+
+    # Return the number of bytes our running jobs on cvm_ip still have to convert, going by their progress.
+    def running_bytes(self,cvm_ip):
+
+        with self.lock:
+            return sum([job["size"] * (100 - job["percent"]) / 100 for job in self.jobs.values() \
+                        if job["status"] == "running" and job["cvm_ip"] == cvm_ip])
+
+    # Convert everything in work, a list of [filename, nfs_path, size], on the CVMs in cvm_ip_list.
+    # A shard of a disk (see SHARD_GB) is [filename, nfs_path, size, byte_range]. Shards are just more
+    # jobs, so the shards of one big disk end up on different CVMs.
+    # Each CVM gets as many jobs as self.admission says it can take right now, MAX_CVM_JOBS at most.
+    # We count the jobs ourselves so we never have to ask the CVMs. Largest disks go first, so a 2 TB
+    # disk doesn't get submitted last and set the finish time for everybody. Whenever a job finishes,
+    # the next disk goes to the CVM with the most free slots (and fewest bytes left).
+    # If given, on_done(job) is called as soon as each job finishes, and no new job is started while
+    # can_start() returns False. The export script uses these to download every qcow2 the moment
+    # it is ready, without piling up more converted files than the downloads can keep up with.
+    # If feed is given, it is a queue.Queue that more work shows up on while we run, in the order it
+    # should be converted, and None on it means nothing else is coming. The import script feeds
+    # each qcow2 in here as soon as its upload is done.
+    # Return when every job is done.
+    def run_all(self,cvm_ip_list,work,on_done=None,can_start=None,feed=None):
+
+        work = sorted(work, key=lambda w: w[2], reverse=True)
+        i = 0
+        runtime = 0
+        all_down_since = None
+        self.cvm_ip_list = cvm_ip_list
+        self.admission.start(cvm_ip_list, self.unhealthy)
+        while i < len(work) or self.running() > 0 or feed is not None:
+            while feed is not None:
+                try:
+                    w = feed.get_nowait()
+                except queue.Empty:
+                    break
+                if w is None:
+                    feed = None
+                else:
+                    work.append(w)
+            self.probe_unhealthy()
+            healthy = [c for c in cvm_ip_list if c not in self.unhealthy]
+            # With no CVM to run them on for CVM_GIVE_UP seconds, the disks still waiting fail.
+            if len(healthy) > 0 or i >= len(work):
+                all_down_since = None
+            elif all_down_since is None:
+                all_down_since = time.time()
+            elif time.time() - all_down_since > CVM_GIVE_UP:
+                print(">>> No CVM answered for %d seconds. Giving up on %d disks. <<<" % (CVM_GIVE_UP, len(work) - i))
+                while i < len(work):
+                    self.give_up(work[i][0], work[i][2], on_done)
+                    i += 1
+            while i < len(work) and len(healthy) > 0:
+                if can_start is not None and not can_start():
+                    break
+                cvm_ip = min(healthy, key=lambda c: (self.running(c) - self.admission.limit(c), \
+                                                     self.running_bytes(c)))
+                if self.running(cvm_ip) >= self.admission.limit(cvm_ip):
+                    break
+                filename, nfs_path, size = work[i][:3]
+                byte_range = work[i][3] if len(work[i]) > 3 else None
+                print("*********")
+                print("Submitting: %s (%0.2f GB) on %s for conversion. Index: %d" \
+                      % (filename, size / 1073741824, cvm_ip, i))
+                if self.start(cvm_ip,filename,nfs_path,size,byte_range) is None:
+                    # Try the next CVM, unless this one still answers. Then it was the disk.
+                    if self.mycluster.cvm_alive(cvm_ip,self.pwd):
+                        self.give_up(filename, size, on_done)
+                        i += 1
+                    else:
+                        self.mark_unhealthy(cvm_ip)
+                        healthy.remove(cvm_ip)
+                    continue
+                i += 1
+            job = self.wait_next(5)
+            if job is not None:
+                # Run it again next, somewhere else. Disks that are done are never moved.
+                if job["status"] == "failed" and self.should_move(job):
+                    work.insert(i, [job["filename"], job["nfs_path"], job["size"], job["byte_range"]])
+                elif on_done is not None:
+                    on_done(job)
+            else:
+                runtime += 5
+                print("%s conversion jobs are still running, %d waiting. Sleeping...(%s seconds)" \
+                      % (self.running(), len(work) - i, runtime))
+                if runtime % 30 == 0:
+                    self.show_progress()
+        self.admission.close()
+
+    # Wait up to timeout seconds for a job to finish. Return the job, or None if nothing finished.
+    def wait_next(self,timeout):
+
+        try:
+            job = self.completed.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        print("Conversion of %s on %s %s. Exit code: %d. Run time: %d seconds." \
+              % (job["filename"], job["cvm_ip"], job["status"], job["rc"], job["end_time"] - job["start_time"]))
+        return job
+
+    # Print every conversion that failed and why. Return their filenames.
+    def report_failures(self):
+
+        with self.lock:
+            failed = [job for job in self.jobs.values() if job["status"] == "failed"]
+        for job in failed:
+            print(">>> Conversion of %s on %s (PID %s) failed with exit code %d. <<<" \
+                  % (job["filename"], job["cvm_ip"], job["pid"], job["rc"]))
+            print(job["log"])
+        return [job["filename"] for job in failed]
+
+# Yield the entities of a REST response one at a time, parsing them as they come off the wire.
+# server_response must come from a request made with stream=True. This way we only ever hold one
+# entity in memory, instead of the whole response and everything json.loads() makes out of it.
+def iter_entities(server_response):
+
+    decoder = json.JSONDecoder()
+    # A character can be split across two chunks.
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    in_entities = False
+    for chunk in server_response.iter_content(chunk_size=65536, decode_unicode=True):
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+        buf += chunk
+        if not in_entities:
+            m = re.search('"entities"\\s*:\\s*\\[', buf)
+            if m is None:
+                continue
+            buf = buf[m.end():]
+            in_entities = True
+        while True:
+            buf = buf.lstrip(" \t\r\n,")
+            if buf.startswith("]"):
+                return
+            try:
+                entity, end = decoder.raw_decode(buf)
+            except ValueError:
+                # We don't have all of this entity yet. Get more.
+                break
+            yield entity
+            buf = buf[end:]
+
+# Functions that want to hear about transfer progress. Each one is called with the transfer_progress
+# of a download or upload every time its numbers are updated.
+progress_callbacks = []
+
+# Progress of one download or upload. Whoever runs the transfer counts the bytes and calls update()
+# with them. We work out the current and average throughput and the ETA, and pass the whole thing on
+# to everything in progress_callbacks.
+class transfer_progress():
+    def __init__(self,filename,vm_name,total,offset=0):
+
+        self.filename = filename
+        self.vm_name = vm_name
+        self.total = total
+        # Bytes that were already there when we started, because we resumed.
+        self.offset = offset
+        self.bytes_done = offset
+        self.start_time = time.time()
+        self.end_time = None
+        self.last_time = self.start_time
+        self.last_bytes = offset
+        # Bytes per second since the last update, and since the start.
+        self.rate = 0.0
+        self.avg_rate = 0.0
+        # Seconds left, or None if we can't tell yet.
+        self.eta = None
+        self.status = "running"
+        # A stream_checksum, if the file is checksummed as it is transferred.
+        self.checksum = None
+
+    def update(self,bytes_done):
+
+        cur_time = time.time()
+        if cur_time > self.last_time:
+            self.rate = max(bytes_done - self.last_bytes, 0) / (cur_time - self.last_time)
+        self.avg_rate = max(bytes_done - self.offset, 0) / max(cur_time - self.start_time, 1)
+        if self.avg_rate > 0:
+            self.eta = max(self.total - bytes_done, 0) / self.avg_rate
+        self.bytes_done = bytes_done
+        self.last_time = cur_time
+        self.last_bytes = bytes_done
+        if self.checksum is not None:
+            self.checksum.feed(bytes_done)
+        for callback in progress_callbacks:
+            callback(self)
+
+    # The transfer is over. ok says whether all of it made it.
+    def finish(self,bytes_done,ok):
+
+        self.update(bytes_done)
+        self.end_time = time.time()
+        self.eta = 0
+        self.status = "done" if ok else "failed"
+
+    # Return how much of the file is done as a percentage. Empty files are 100% done.
+    def percent(self):
+
+        if self.total == 0:
+            return 100.0
+        return (self.bytes_done / self.total) * 100
+
+    # Print a line like "<file> for <vm> downloaded: 42.00%. ..." where verb is downloaded/uploaded.
+    def show(self,verb):
+
+        runtime = (self.end_time or time.time()) - self.start_time
+        if self.eta is None:
+            eta = "unknown"
+        else:
+            eta = "%d seconds" % self.eta
+        print(self.filename, "for", self.vm_name, "%s: %0.2f%%. %0.2f MB/s now, %0.2f MB/s average. ETA: %s. Run time: %d seconds." \
+              %(verb, self.percent(), self.rate / 1048576, self.avg_rate / 1048576, eta, runtime))
+
+# Return how far process pid has got reading or writing path, from its file position in
+# /proc/<pid>/fdinfo. sftp runs under sshpass, so we look at the children of pid as well.
+# This lets us count the bytes of an upload locally, without asking the sftp server.
+# Return None if none of them has path open.
+def file_position(pid,path):
+
+    path = os.path.realpath(path)
+    pids = [pid]
+    while len(pids) > 0:
+        p = pids.pop()
+        try:
+            for fd in os.listdir("/proc/%d/fd" % p):
+                try:
+                    if os.readlink("/proc/%d/fd/%s" % (p, fd)) != path:
+                        continue
+                    fdinfo = open("/proc/%d/fdinfo/%s" % (p, fd), "r")
+                    for line in fdinfo:
+                        if line.startswith("pos:"):
+                            fdinfo.close()
+                            return int(line.split()[1])
+                    fdinfo.close()
+                except OSError:
+                    continue
+            children = open("/proc/%d/task/%d/children" % (p, p), "r")
+            pids.extend([int(c) for c in children.read().split()])
+            children.close()
+        except OSError:
+            continue
+    return None
+
+# Return pid and all of its descendants.
+def process_tree(pid):
+
+    tree = []
+    pids = [pid]
+    while len(pids) > 0:
+        p = pids.pop()
+        tree.append(p)
+        try:
+            children = open("/proc/%d/task/%d/children" % (p, p), "r")
+            pids.extend([int(c) for c in children.read().split()])
+            children.close()
+        except OSError:
+            continue
+    return tree
+
+# How often the bandwidth limiter looks at the transfers, and how many seconds worth of its share a
+# transfer can save up and then use in one go.
+BANDWIDTH_TICK=0.25
+BANDWIDTH_BURST=1.0
+
+# Keeps all transfers and REST calls of a script under one bandwidth limit (see BANDWIDTH_LIMIT).
+# Transfers are sftp processes, so we can't slow down their reads and writes. Instead every transfer
+# has a token bucket, which fills up at its share of the limit every BANDWIDTH_TICK seconds. We count
+# the bytes each transfer moved since the last tick with its measure function and take them out of
+# its bucket. A transfer that is out of tokens is stopped (SIGSTOP) until it has some again. REST
+# calls share one bucket, and wait in rest_hook() until it isn't empty. What a full bucket can't
+# hold goes to the buckets that are empty.
+class bandwidth_limiter():
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        # Key is the PID of a transfer, value is {"measure", "offset", "last", "tokens", "stopped"}.
+        self.transfers = {}
+        self.rest = {"tokens": 0.0, "used": 0}
+        # REST responses whose body may still be coming, and how many bytes we counted of each.
+        self.responses = weakref.WeakKeyDictionary()
+        # Bytes per second, or None if there is no limit.
+        self.cap = None
+        self.reload = threading.Event()
+        self.thread = None
+
+    # Start enforcing the limit. Has to be called from the main thread, because of the signal.
+    def start(self):
+
+        if self.thread is not None:
+            return
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.reload.set())
+        atexit.register(self.resume_all)
+        self.update_cap()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Return the limit in MB/s: the control file, then the schedule, then BANDWIDTH_LIMIT.
+    def current_limit(self):
+
+        try:
+            fp = open(DIR + "/" + BANDWIDTH_CONTROL, "r")
+            limit = float(fp.read().strip())
+            fp.close()
+            return limit
+        except (OSError, ValueError):
+            pass
+        now = time.strftime("%H:%M")
+        for start, end, limit in BANDWIDTH_SCHEDULE:
+            if start <= end and start <= now < end:
+                return limit
+            if start > end and (now >= start or now < end):
+                return limit
+        return BANDWIDTH_LIMIT
+
+    def update_cap(self):
+
+        limit = self.current_limit()
+        cap = limit * 1048576 if limit > 0 else None
+        if cap != self.cap:
+            if cap is None:
+                print("No bandwidth limit.")
+            else:
+                print("Bandwidth limit: %0.2f MB/s." % limit)
+        self.cap = cap
+
+    # A transfer started. measure() returns how many bytes it moved so far, or None if it can't tell.
+    # offset is where a resumed transfer starts. What came before it was moved by an earlier transfer,
+    # even if measure() can only see it once sftp has the file open.
+    def add(self,pid,measure,offset=0):
+
+        with self.lock:
+            self.transfers[pid] = {"measure": measure, "offset": offset, "last": max(measure() or 0, offset), \
+                                   "tokens": 0.0, "stopped": False}
+
+    def remove(self,pid):
+
+        with self.lock:
+            t = self.transfers.pop(pid, None)
+            if t is not None and t["stopped"]:
+                self.signal(pid, signal.SIGCONT)
+
+    def signal(self,pid,signum):
+
+        for p in process_tree(pid):
+            try:
+                os.kill(p, signum)
+            except OSError:
+                pass
+
+    def resume_all(self):
+
+        with self.lock:
+            for pid, t in self.transfers.items():
+                if t["stopped"]:
+                    self.signal(pid, signal.SIGCONT)
+                    t["stopped"] = False
+
+    # Response hook for the REST sessions. Count what we sent and wait if we are over. The body of the
+    # response hasn't been read yet. tick() counts it as it comes in, however it is sent.
+    def rest_hook(self,response,*args,**kwargs):
+
+        nbytes = len(response.request.body or b"")
+        with self.lock:
+            self.rest["used"] += nbytes
+            if response.raw is not None:
+                self.responses[response.raw] = 0
+        while self.cap is not None:
+            with self.lock:
+                if self.rest["tokens"] >= 0:
+                    break
+            time.sleep(BANDWIDTH_TICK)
+
+    def run(self):
+
+        last_time = time.time()
+        last_check = last_time
+        while True:
+            self.reload.wait(BANDWIDTH_TICK)
+            cur_time = time.time()
+            if self.reload.is_set() or cur_time - last_check >= 10:
+                self.reload.clear()
+                self.update_cap()
+                last_check = cur_time
+            with self.lock:
+                self.tick(cur_time - last_time)
+            last_time = cur_time
+
+    def tick(self,interval):
+
+        for t in self.transfers.values():
+            cur = t["measure"]()
+            if cur is None:
+                continue
+            cur = max(cur, t["offset"])
+            # A transfer that starts over moved nothing.
+            t["tokens"] -= max(cur - t["last"], 0)
+            t["last"] = cur
+        for raw, last in list(self.responses.items()):
+            try:
+                cur = raw.tell()
+            except Exception:
+                cur = last
+            self.rest["used"] += max(cur - last, 0)
+            if getattr(raw, "closed", True):
+                del self.responses[raw]
+            else:
+                self.responses[raw] = cur
+        self.rest["tokens"] -= self.rest["used"]
+        self.rest["used"] = 0
+
+        buckets = list(self.transfers.values()) + [self.rest]
+        if self.cap is None:
+            for b in buckets:
+                b["tokens"] = 0.0
+        else:
+            share = self.cap * interval / len(buckets)
+            burst = self.cap * BANDWIDTH_BURST / len(buckets)
+            spare = 0.0
+            for b in buckets:
+                b["tokens"] += share
+                if b["tokens"] > burst:
+                    spare += b["tokens"] - burst
+                    b["tokens"] = burst
+            empty = [b for b in buckets if b["tokens"] < 0]
+            for b in empty:
+                b["tokens"] = min(b["tokens"] + spare / len(empty), burst)
+
+        for pid, t in self.transfers.items():
+            if t["tokens"] < 0 and not t["stopped"]:
+                self.signal(pid, signal.SIGSTOP)
+                t["stopped"] = True
+            elif t["tokens"] >= 0 and t["stopped"]:
+                self.signal(pid, signal.SIGCONT)
+                t["stopped"] = False
+
+# The one bandwidth limiter of a script.
+bandwidth = bandwidth_limiter()
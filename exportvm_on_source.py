@@ -14,69 +14,122 @@ import re
 import sys
 import json
 import time
+import queue
 import argparse
 import requests
 import threading
 import subprocess
+import concurrent.futures
 import clusterconfig as C
 from pprint import pprint
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 
+# Every download that has been started. Key is the filename, value is its C.transfer_progress.
+# Download threads add to this and show_progress() updates and prints it, so we get one combined
+# progress view.
+transfers = {}
+transfers_lock = threading.Lock()
+
 # Call subprocess to fire up sftp. Would have been nice to use paramiko for file transfer
 # it wasn't for https://github.com/paramiko/paramiko/issues/822 which causes rekeys and 
 # file transfer terminations. It times out over SFTP also.
 # 1. Get file size of srcfilepath.
 # 2. Construct list to pass to subprocess.Popen().
-# 3. Start sftp in a thread. Its in a thread so we can display download information. (X % in Y seconds etc)
-# 4. Sleep until complete, printing out progress every 5 seconds.
+# 3. Run sftp, resuming with reget if a partial copy of the file is already in DIR.
+#    Record the download in transfers{} so show_progress() can report on it.
+# 4. With CHECKSUMS, check the file in DIR against the one on the cluster and save its checksum.
+# 5. Return True if the whole file made it to DIR, False otherwise.
+# This runs in one of the download threads, so we return instead of calling sys.exit().
 def sftp_download(filename, vm_name):
 
     user = C.src_cluster_admin + "@" + C.src_cluster_ip 
     pwd = "-p" + C.src_cluster_pwd
 
-    def run_sftp(srcfilepath,dstfilepath):
-
+    # Return the size of path, or None if it isn't there yet.
+    def local_size(path):
         try:
-            retr_user = user + ":" + srcfilepath
-            # If we don't turn off StrictHostKeyChecking, sftp fails with Host key verification error.
-            # We need the while True loop because every now and then we get Permission denied errors 
-            # from the sftp server.
-            error_count=0
-            while True:
-                if C.large_file_opt == True:
-                    sp = subprocess.Popen(['sshpass', pwd, 'sftp', '-B', '131072', '-P', '2222', \
-                                             '-o', 'StrictHostKeyChecking=no', retr_user, dstfilepath], \
-                                            text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                else:
-                    sp = subprocess.Popen(['sshpass', pwd, 'sftp', '-P', '2222', '-o', \
-                                             'StrictHostKeyChecking=no', retr_user, dstfilepath], \
-                                            text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    def run_sftp(srcfilepath,dstfilepath,srcfilesize):
+
+        # If we don't turn off StrictHostKeyChecking, sftp fails with Host key verification error.
+        if C.large_file_opt == True:
+            cmd_lst = ['sshpass', pwd, 'sftp', '-B', '131072', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
+        else:
+            cmd_lst = ['sshpass', pwd, 'sftp', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
+
+        # We need the retry loop because every now and then we get Permission denied errors
+        # from the sftp server, and large files sometimes error out part way through.
+        # Every retry picks up from where the last one stopped.
+        attempt=0
+        while True:
+            try:
+                offset = os.stat(dstfilepath).st_size
+            except OSError:
+                offset = 0
+            # Only resume if what we already have matches the file on the cluster.
+            if offset > 0 and C.RESUME_TRANSFERS == True:
+                if offset > srcfilesize or not mycluster.sftp_tail_matches(srcfilepath,dstfilepath,offset):
+                    print("%s does not match %s. Starting over." % (dstfilepath, srcfilepath))
+                    os.remove(dstfilepath)
+                    offset = 0
+            if offset == srcfilesize and offset > 0:
+                return True
+            if offset > 0 and C.RESUME_TRANSFERS == True:
+                get_str = "reget " + srcfilepath + " " + dstfilepath + "\n"
+                print("Resuming download of %s at byte %d." % (srcfilepath, offset))
+            else:
+                get_str = "get " + srcfilepath + " " + dstfilepath + "\n"
+                # Whatever we checksummed so far is about to be written over.
+                if progress.checksum is not None:
+                    if os.path.exists(dstfilepath):
+                        os.remove(dstfilepath)
+                    progress.checksum.reset()
 
-                out,err = sp.communicate()
+            try:
+                sp = subprocess.Popen(cmd_lst, text=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
+                                      stderr=subprocess.PIPE)
+                # Keep the download under the bandwidth limit, by how fast dstfilepath grows.
+                C.bandwidth.add(sp.pid, lambda: local_size(dstfilepath), offset if get_str.startswith("reget") else 0)
+                try:
+                    out,err = sp.communicate(input=get_str)
+                finally:
+                    C.bandwidth.remove(sp.pid)
                 print("Popen out from sftp: ", out)
                 print("Popen err: ", err)
+            except Exception as ex:
+                print("Subprocess failed while downloading %s." % srcfilepath)
+                pprint(ex)
 
-                perms_regex = "Permission denied"
-                searchObj = re.search(perms_regex,err)
-                if searchObj:
-                    if error_count == 3:
-                        print(">>> Giving up after %d attempts. <<<" % error_count)
-                        sys.exit(1)
-                    error_count = error_count + 1
-                    print("Sftp pipe: Permission denied..sleeping and trying again. %d." % error_count)
-                    time.sleep(5)
-                else:
-                    break
-        except Exception as ex:
-            print("Subprocess failed while downloading %s." % srcfilepath)
-            pprint(ex)
-            sys.exit(1)
-        return
+            try:
+                dstfilesize = os.stat(dstfilepath).st_size
+            except OSError:
+                dstfilesize = 0
+            if dstfilesize == srcfilesize:
+                return True
+
+            attempt = attempt + 1
+            if attempt > C.TRANSFER_RETRIES:
+                print(">>> Giving up on %s after %d attempts. <<<" % (srcfilepath, attempt))
+                return False
+            print("Sftp pipe: %s stopped at byte %d of %d..sleeping %d seconds and trying again. %d." \
+                  % (srcfilepath, dstfilesize, srcfilesize, C.backoff(attempt), attempt))
+            time.sleep(C.backoff(attempt))
     
     srcfilepath = "/" + C.EXPORTCONTAINER + "/" + filename
     dstfilepath = C.DIR + "/" + filename
 
+    # Don't even ask the cluster about a file an earlier run downloaded, if we still have it.
+    last_step = "verified" if C.CHECKSUMS == True else "transferred"
+    if journal.reached("disk", filename, last_step) and \
+       (os.path.exists(dstfilepath) or os.path.exists(dstfilepath + C.ZBLK_SUFFIX) or \
+        os.path.exists(dstfilepath + C.RECIPE_SUFFIX)):
+        print("%s was downloaded by an earlier run." % filename)
+        return True
+
     error_count=0
     while True:
         srcfilesize = mycluster.sftp_ls(user,pwd,srcfilepath)
@@ -86,63 +139,321 @@ def sftp_download(filename, vm_name):
         elif srcfilesize == -1:
             print("Sftp_ls could not stat %s on cluster." % srcfilepath)
             print(">>> Did you run this script with --qemu to create it first? <<<")
-            sys.exit(1)
-        elif srcfilesize == -2:
-            error_count = error_count + 1
+            return False
+        error_count = error_count + 1
+        if error_count > C.TRANSFER_RETRIES:
+            print(">>> Giving up after %d attempts. <<<" % error_count)
+            return False
+        if srcfilesize == -2:
             print("Sftp_ls: Permission denied..sleeping and trying again. %d." % error_count)
-            time.sleep(5)
         # Some other weird error from sftp. Increase error count so we can sleep and try again..
         else:
-            error_count = error_count + 1
             print("Sftp_ls: Unknown error..sleeping and trying again. %d." % error_count)
-            time.sleep(5)
-        if error_count == 3:
-            print(">>> Giving up after %d attempts. <<<" % error_count)
-            sys.exit(1)
+        time.sleep(C.backoff(error_count))
     
-    print ("Starting download..hang on..")
-    start_time = round(time.time())
-    t=threading.Thread(target=run_sftp,args=(srcfilepath,dstfilepath))
-    t.start()
-    time.sleep(1)
+    # With DEDUP_STORE or LOCAL_COMPRESS, an earlier run may have downloaded and stored it already.
+    if C.DEDUP_STORE == True and not os.path.exists(dstfilepath):
+        if C.recipe_size(dstfilepath + C.RECIPE_SUFFIX) == srcfilesize:
+            print("%s is already in %s." % (filename + C.RECIPE_SUFFIX, C.DIR))
+            return True
+    elif C.LOCAL_COMPRESS == True and not os.path.exists(dstfilepath):
+        index = C.zblk_index(dstfilepath + C.ZBLK_SUFFIX)
+        if index is not None and index["size"] == srcfilesize:
+            print("%s is already in %s." % (filename + C.ZBLK_SUFFIX, C.DIR))
+            return True
 
-    while t.is_alive():
-        try:
-            dstfilesize = os.stat(dstfilepath).st_size
-        # An exception here is most likely if os.stat failed because the download didn't begin yet.
-        except:
-            dstfilesize = 0
-            time.sleep(5)
-        cur_time = round(time.time())
-        runtime = cur_time - start_time
-        print(srcfilepath, "for", vm_name, "downloaded: %0.2f%%. Run time: %d seconds." \
-              %(((dstfilesize / srcfilesize) * 100), runtime))
-        time.sleep(5)
+    # Only carry on with a file that a download of this version of the disk left in DIR, in this run
+    # or an earlier one. Anything else by that name starts over.
+    if os.path.exists(dstfilepath) and not journal.reached("disk", filename, "transferring"):
+        print("%s is not from a download of this disk. Starting over." % dstfilepath)
+        os.remove(dstfilepath)
+    journal.done("disk", filename, "transferring")
+    try:
+        offset = os.stat(dstfilepath).st_size
+    except OSError:
+        offset = 0
+    print ("Starting download of %s for %s..hang on.." % (srcfilepath, vm_name))
+    progress = C.transfer_progress(srcfilepath, vm_name, srcfilesize, offset)
+    progress.localpath = dstfilepath
+    # sftp can have a few requests in flight past the end of what it wrote, so the checksum keeps
+    # a block behind.
+    if C.CHECKSUMS == True:
+        progress.checksum = C.stream_checksum(dstfilepath, C.CHECKSUM_BLOCK)
+    with transfers_lock:
+        transfers[filename] = progress
+    ok = run_sftp(srcfilepath,dstfilepath,srcfilesize)
 
     # How long did it take for 100% of the file to transfer over?
     try:
-        if (dstfilesize / srcfilesize) != 1:
-            dstfilesize = os.stat(dstfilepath).st_size
-            cur_time = round(time.time())
-            runtime = cur_time - start_time
-            print(srcfilepath, "for", vm_name, "downloaded: %0.2f%%. Run time: %d seconds." \
-                  %(((dstfilesize / srcfilesize) * 100), runtime))
-    # If dstfilesize isn't defined then the thread never got started.
-    except NameError:
+        dstfilesize = os.stat(dstfilepath).st_size
+    # If the file isn't there then sftp never got started.
+    except OSError:
         print(">>> Could not start sftp. Does it work from the command-line? <<<")
         print("sftp -P 2222 -o StrictHostKeyChecking=no ", user)
-        sys.exit(1)
-    
-    return
+        dstfilesize = 0
+        ok = False
+    if dstfilesize != srcfilesize:
+        ok = False
+
+    with transfers_lock:
+        progress.finish(dstfilesize, ok)
+    progress.show("downloaded")
+    if ok:
+        journal.done("disk", filename, "transferred")
+
+    if ok and progress.checksum is not None:
+        checksum = progress.checksum.result(dstfilesize)
+        if mycluster.verify_checksum(srcfilepath, checksum) == False:
+            print(">>> Removing %s so it is downloaded again next time. <<<" % dstfilepath)
+            os.remove(dstfilepath)
+            return False
+        C.save_checksum(filename, checksum)
+        journal.done("disk", filename, "verified")
+    return ok
+
+# Print one line per download in flight, followed by a line with the totals so far.
+# We count the bytes of each download by looking at the file it is writing in DIR.
+def show_progress(nfiles, start_time):
+
+    with transfers_lock:
+        all_transfers = list(transfers.values())
+    cur_time = time.time()
+    total_bytes = 0
+    ndone = 0
+    for t in all_transfers:
+        if t.status != "running":
+            ndone += 1
+            total_bytes += t.bytes_done
+            continue
+        try:
+            t.update(os.stat(t.localpath).st_size)
+        # An exception here is most likely if os.stat failed because the download didn't begin yet.
+        except OSError:
+            pass
+        total_bytes += t.bytes_done
+        t.show("downloaded")
+    runtime = max(cur_time - start_time, 1)
+    print("=== %d of %d files done. %0.2f GB downloaded. Run time: %d seconds. Total throughput: %0.2f MB/s." \
+          %(ndone, nfiles, total_bytes / 1073741824, runtime, total_bytes / runtime / 1048576))
+
+# Compress filename in DIR on all our cores and remove it once it is compressed. Return False if
+# we couldn't compress it. Then the qcow2 file stays in DIR as it is.
+def compress_download(filename):
+
+    srcfilepath = C.DIR + "/" + filename
+    dstfilepath = srcfilepath + C.ZBLK_SUFFIX
+    start_time = time.time()
+    try:
+        C.zblk_compress(srcfilepath, dstfilepath)
+    except Exception as ex:
+        print("Could not compress %s." % srcfilepath)
+        print(ex)
+        return False
+    size = os.stat(srcfilepath).st_size
+    compressed = os.stat(dstfilepath).st_size
+    os.remove(srcfilepath)
+    runtime = max(time.time() - start_time, 1)
+    print("Compressed %s to %0.2f%% in %d seconds. %0.2f MB/s." \
+          % (filename, (compressed / max(size, 1)) * 100, runtime, size / runtime / 1048576))
+    return True
+
+# Put the chunks of filename in DIR that we don't have yet into the chunk store, write its recipe,
+# and remove it. Return False if we couldn't. Then the qcow2 file stays in DIR as it is.
+def dedup_download(filename):
+
+    srcfilepath = C.DIR + "/" + filename
+    start_time = time.time()
+    try:
+        size, new_bytes = C.get_chunk_store().add_file(srcfilepath, srcfilepath + C.RECIPE_SUFFIX)
+    except Exception as ex:
+        print("Could not add %s to the chunk store." % srcfilepath)
+        print(ex)
+        return False
+    os.remove(srcfilepath)
+    runtime = max(time.time() - start_time, 1)
+    print("Stored %s: %0.2f GB of %0.2f GB were new. %d seconds." \
+          % (filename, new_bytes / 1073741824, size / 1073741824, runtime))
+    return True
+
+# Remove filename from EXPORTCONTAINER once we have it in DIR, along with its record in the
+# conversion cache if it has one.
+def sftp_remove(filename):
+
+    user = C.src_cluster_admin + "@" + C.src_cluster_ip
+    pwd = "-p" + C.src_cluster_pwd
+    cmd_lst = ['sshpass', pwd, 'sftp', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
+    rm_str = "rm /" + C.EXPORTCONTAINER + "/" + filename + "\n"
+    if C.CONVERSION_CACHE == True:
+        rm_str = rm_str + "rm /" + C.EXPORTCONTAINER + "/" + filename + C.CACHE_SUFFIX + "\n"
+    try:
+        sp = subprocess.Popen(cmd_lst, text=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
+                              stderr=subprocess.PIPE)
+        out,err = sp.communicate(input=rm_str)
+    except Exception as ex:
+        print("Could not remove %s from %s." % (filename, C.EXPORTCONTAINER))
+        print(ex)
+
+# Downloads files as they are handed to it with add(), streams of them at a time, while the rest of
+# the script carries on. With --qemu every qcow2 is handed over the moment its conversion is done,
+# so conversions and downloads overlap. pending() is the number of files that were handed over and
+# are not downloaded yet. The conversion scheduler looks at it to hold back when downloads can't
+# keep up. Combined progress is printed every 5 seconds until finish() is called.
+# With a C.adaptive_limit, streams is the most downloads we run, and limit decides how many of them
+# actually run at any time.
+class download_pipeline():
+    def __init__(self, nfiles, streams, limit=None):
+
+        self.work = queue.Queue()
+        self.nfiles = nfiles
+        self.failed = []
+        self.npending = 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stop = threading.Event()
+        self.limit = limit
+
+        streams = max(1, min(streams, nfiles))
+        if limit is None:
+            print("Downloading %d files, %d at a time." % (nfiles, streams))
+        self.threads = []
+        for i in range(streams):
+            t = threading.Thread(target=self.download_worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+        self.progress_thread = threading.Thread(target=self.progress_worker, daemon=True)
+        self.progress_thread.start()
+
+    # Download filename for vm_name as soon as a download thread is free.
+    def add(self, filename, vm_name):
+
+        with self.lock:
+            self.npending += 1
+        self.work.put([filename, vm_name])
+
+    def pending(self):
+
+        with self.lock:
+            return self.npending
+
+    def download_worker(self):
 
-# Get list of all VMs.
-def get_all_vm_info(mycluster):
+        while True:
+            l = self.work.get()
+            # finish() tells us there is nothing more to download.
+            if l is None:
+                return
+            filename, vm_name = l
+            if self.limit is not None:
+                self.limit.acquire()
+            try:
+                ok = sftp_download(filename, vm_name)
+            finally:
+                if self.limit is not None:
+                    self.limit.release()
+            if not ok:
+                with self.lock:
+                    self.failed.append(filename)
+            else:
+                if C.DEDUP_STORE == True and os.path.exists(C.DIR + "/" + filename):
+                    dedup_download(filename)
+                elif C.LOCAL_COMPRESS == True and os.path.exists(C.DIR + "/" + filename):
+                    compress_download(filename)
+                if C.REMOVE_AFTER_DOWNLOAD == True:
+                    sftp_remove(filename)
+            with self.lock:
+                self.npending -= 1
+
+    def progress_worker(self):
+
+        while not self.stop.wait(5):
+            show_progress(self.nfiles, self.start_time)
+
+    # No more files are coming. Wait for the downloads to finish.
+    # Return a list of the files that could not be downloaded.
+    def finish(self):
+
+        for t in self.threads:
+            self.work.put(None)
+        for t in self.threads:
+            t.join()
+        self.stop.set()
+        self.progress_thread.join()
+        if self.limit is not None:
+            self.limit.close()
+        show_progress(self.nfiles, self.start_time)
+        return self.failed
+
+# Add the VMs of this export to the manifest in DIR. VMs from earlier exports to the same DIR stay
+# in it. A disk that didn't make it to DIR is recorded without bytes, so the import won't look for it.
+def write_manifest(manifest_vms, failed):
+
+    manifest = C.load_manifest()
+    if manifest is None:
+        manifest = {"vms": {}}
+    for vm_uuid, vm in manifest_vms.items():
+        for disk in vm["disks"]:
+            disk["bytes"] = None
+            if disk["filename"] in failed:
+                continue
+            # With DEDUP_STORE or LOCAL_COMPRESS, the qcow2 file is only in DIR if we couldn't
+            # store or compress it.
+            try:
+                disk["bytes"] = os.stat(C.DIR + "/" + disk["filename"]).st_size
+            except OSError:
+                index = C.zblk_index(C.DIR + "/" + disk["filename"] + C.ZBLK_SUFFIX)
+                size = C.recipe_size(C.DIR + "/" + disk["filename"] + C.RECIPE_SUFFIX)
+                if size is not None:
+                    disk["bytes"] = size
+                    disk["recipe"] = disk["filename"] + C.RECIPE_SUFFIX
+                elif index is not None:
+                    disk["bytes"] = index["size"]
+                    disk["compressed"] = disk["filename"] + C.ZBLK_SUFFIX
+                else:
+                    continue
+            checksum = C.load_checksum(disk["filename"])
+            if checksum is not None:
+                disk["sha256"] = checksum["sha256"]
+                disk["sums"] = C.checksum_file(disk["filename"])
+        manifest["vms"][vm_uuid] = vm
+    C.save_manifest(manifest)
+    print("Wrote %d VMs to %s/%s" % (len(manifest_vms), C.DIR, C.MANIFEST))
+
+# Yield every VM on the cluster that is in power_state, with its disk and NIC config, page_size
+# VMs at a time. We ask the cluster to filter on power state. If it doesn't understand that, we
+# filter here, starting over from the first page since the pages don't line up. Each VM is parsed as
+# it comes in, so we never hold the whole inventory in memory.
+def get_all_vm_info(mycluster, power_state, page_size=100):
     
-    cluster_url = mycluster.base_urlv2 + \
-                  "vms/?include_vm_disk_config=true&include_vm_nic_config=true"
-    server_response = mycluster.sessionv2.get(cluster_url)
-    # print("Response code: ",server_response.status_code)
-    return server_response.status_code, json.loads(server_response.text)
+    vm_filter = "&filter=power_state==" + power_state
+    seen = set()
+    offset = 0
+    while True:
+        cluster_url = mycluster.base_urlv2 + \
+                      "vms/?include_vm_disk_config=true&include_vm_nic_config=true" + \
+                      "&offset=%d&length=%d" % (offset, page_size) + vm_filter
+        server_response = mycluster.sessionv2.get(cluster_url, stream=True)
+        # print("Response code: ",server_response.status_code)
+        if server_response.status_code != 200:
+            if vm_filter != "":
+                vm_filter = ""
+                offset = 0
+                continue
+            print("Could not get VMs. Response code: %s" % server_response.status_code)
+            return
+        nvms = 0
+        nnew = 0
+        for vm_dict in C.iter_entities(server_response):
+            nvms += 1
+            # Some versions ignore offset and length and always send everything.
+            if vm_dict["uuid"] in seen:
+                continue
+            seen.add(vm_dict["uuid"])
+            nnew += 1
+            if vm_dict["power_state"] == power_state:
+                yield vm_dict
+        if nvms < page_size or nnew == 0:
+            return
+        offset += page_size
     
 # Get virtual disk information.
 def get_vdisk_info(mycluster, vmdisk_uuid):
@@ -152,17 +463,62 @@ def get_vdisk_info(mycluster, vmdisk_uuid):
     # print("Response code: ",server_response.status_code)
     return server_response.status_code, json.loads(server_response.text)
 
+# Return a dict keyed by vmdisk_uuid with the virtual disk information of every vdisk in
+# vmdisk_uuids. One paged listing of all virtual disks gets most of them in a few requests.
+# Anything that isn't in there is fetched by itself, C.REST_THREADS at a time. A vdisk we couldn't
+# look up is left out, and the failure is printed.
+def get_vdisk_index(mycluster, vmdisk_uuids):
+
+    wanted = set(vmdisk_uuids)
+    vdisk_index = {}
+    print("Getting virtual disk inventory")
+    status, all_vdisks = mycluster.get_paged(mycluster.base_urlv2 + "virtual_disks/")
+    print("Response code: %s. %d virtual disks." % (status, len(all_vdisks)))
+    if status != 200:
+        all_vdisks = []
+    for vdisk in all_vdisks:
+        if vdisk.get("uuid") in wanted and vdisk.get("nutanix_nfsfile_path"):
+            vdisk_index[vdisk["uuid"]] = vdisk
+
+    missing = [u for u in wanted if u not in vdisk_index]
+    if len(missing) > 0:
+        print("Getting %d virtual disks one at a time." % len(missing))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=C.REST_THREADS) as pool:
+            results = pool.map(lambda u: get_vdisk_info(mycluster, u), missing)
+            for vmdisk_uuid, (status, vdisk_info) in zip(missing, results):
+                if status != 200:
+                    print(">>> Could not look up vdisk %s. Response code: %s <<<" % (vmdisk_uuid, status))
+                    pprint(vdisk_info)
+                    continue
+                vdisk_index[vmdisk_uuid] = vdisk_info
+    return vdisk_index
+
 if __name__ == "__main__":
     try:
         parser = argparse.ArgumentParser()
         parser.add_argument("--qemu", action='store_true', help="Run qemu-img convert on vdisks. (default is no)")
+        parser.add_argument("--incremental", action='store_true', \
+                            help="With --qemu, only export what changed since the last export. (default is no)")
+        parser.add_argument("--streams", type=int, default=None, \
+                            help="Number of files to download at the same time. (default is to adapt to the drive and network, see ADAPTIVE_TRANSFERS)")
         parser.add_argument("csvfile", type=str, help="CSV File with VM names")
         args = parser.parse_args()
 
         csvfile = args.csvfile
+        if args.incremental and not args.qemu:
+            print(">>> --incremental needs --qemu. <<<")
+            sys.exit(1)
+        C.bandwidth.start()
 
         requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
         mycluster = C.my_api(C.src_cluster_ip, C.src_cluster_admin, C.src_cluster_pwd)
+        # How far each disk got in earlier runs. See C.run_journal.
+        try:
+            journal = C.run_journal("export", C.EXPORT_STEPS)
+        except Exception as ex:
+            print("Cannot write to", C.DIR, ex)
+            print(">>> Did you remember to update the config file? <<<")
+            sys.exit(1)
         status, cluster = mycluster.get_cluster_information()
         if status != 200:
             print("Cannot connect to: %s" % cluster)
@@ -198,6 +554,7 @@ if __name__ == "__main__":
         for container in all_containers:
             if container["name"] == C.EXPORTCONTAINER:
                 storage_container_uuid = container["storage_container_uuid"]
+                export_container = container
         try:
             print("Container: %s. UUID: %s" % (C.EXPORTCONTAINER, storage_container_uuid))
         except NameError:
@@ -209,28 +566,32 @@ if __name__ == "__main__":
         important_vms = mycluster.get_important_vms(csvfile)
         # pprint(important_vms)
         
-        # Get information about all VMS.
-        status, all_vms = get_all_vm_info(mycluster)
-        all_vms_list = all_vms["entities"]
-        # pprint(all_vms_list)
-        
-        # nfsfile_list[] is a list of dictionaries. 
-        # Each dict has key = vmuuid, value is nfs file path.
+        # nfsfile_list[] is a list of lists. 
+        # Each one is [vm_uuid, nfs file path, disk label, vm name, disk size in bytes, qcow2 file,
+        # byte range]. The byte range is the [offset, length] of a shard in its vdisk, None for the
+        # whole vdisk.
         # By the end of this loop, this dictionary will have all the information neccessary to
         # convert and download the files.
         nfsfile_list = []
+        # The non CD-ROM disks of the VMs we export, as [vm_uuid, vm_name, vm_disk_dict].
+        vm_disk_list = []
+        # What goes into the manifest for each VM we export, keyed by UUID.
+        manifest_vms = {}
+        # Which version of each VM this is, for the journal.
+        vm_keys = {}
+        # What each qcow2 file has to be converted from. See C.conversion_cache.
+        cache_keys = {}
         # Get VM info for each VM.
-        for vm_dict in all_vms_list:
+        # If the VM is not powered off, no reason to move forward.
+        for vm_dict in get_all_vm_info(mycluster, "off"):
 
-            # If the VM is not powered off, no reason to move forward.
-            if vm_dict["power_state"] != "off":
-                continue
-            
             vm_name = vm_dict["name"]
             vm_uuid = vm_dict["uuid"]
             # If the VM is not an important VM, then continue.
             if vm_name not in important_vms:
                 continue
+            # The disks of a VM that changed since an earlier run are exported again.
+            vm_keys[vm_uuid] = str(vm_dict.get("vm_logical_timestamp", ""))
             
             print("*** NAME: %s." % vm_dict["name"])
             print("*** UUID: %s." % vm_dict["uuid"])
@@ -251,101 +612,202 @@ if __name__ == "__main__":
             
             f.write(vm_json)
             f.close()
+            manifest_vms[vm_uuid] = {
+                "name": vm_name,
+                "uuid": vm_uuid,
+                "cfg": vm_uuid + ".cfg",
+                "exported": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "disks": []
+            }
             
-            # Get vdisk information.            
+            # Remember the disks. We look up their vdisks for all VMs at once below.
             for vm_disk_dict in vm_dict["vm_disk_info"]:
                 # print ("Entering vm_disk_dict loop: for %s at %s" \
                 # % (vm_name, time.strftime("%H:%M:%S")))
                 # pprint(vm_disk_dict)
                 if vm_disk_dict["is_cdrom"]:
                     continue
-                
-                disk_label = vm_disk_dict["disk_address"]["disk_label"]
-                vmdisk_uuid = vm_disk_dict["disk_address"]["vmdisk_uuid"]
-                # print "FFFF FOUND VM_DISK_UUID", vmdisk_uuid, " ", disk_label
-                
-                status, vdisk_info = get_vdisk_info(mycluster, vmdisk_uuid)
-                # print "VVVVVVVVVVVVV VDISK INFO"
-                # pprint(vdisk_info)
-                l = []
-                l = [vm_uuid, vdisk_info["nutanix_nfsfile_path"], disk_label, vm_name]
+                vm_disk_list.append([vm_uuid, vm_name, vm_disk_dict])
+
+        # With --incremental, export the changes to each disk since the last export, if the qcow2 file
+        # of the last export is still in EXPORTCONTAINER and is the one the manifest in DIR says we
+        # downloaded. Otherwise export all of it. Return the filename, and what a delta is based on.
+        last_manifest = C.load_manifest() if args.incremental else None
+        def export_filename(vm_uuid, disk_label):
+            filename = vm_uuid + "_" + disk_label + ".qcow2"
+            if not args.incremental:
+                return filename, None
+            delta = re.sub(".qcow2$", C.DELTA_SUFFIX, filename)
+            base = None
+            sharded = False
+            if last_manifest is not None and vm_uuid in last_manifest["vms"]:
+                for disk in last_manifest["vms"][vm_uuid]["disks"]:
+                    if disk.get("shard_of") == filename:
+                        sharded = True
+                    elif disk["filename"] == filename and disk.get("bytes") is not None:
+                        base = {"filename": filename, "bytes": disk["bytes"], "sha256": disk.get("sha256")}
+                    # Deltas all go back to the same full export.
+                    elif disk["filename"] == delta and disk.get("base") is not None:
+                        base = disk["base"]
+            # Deltas only go on top of a whole disk. See C.SHARD_GB.
+            if sharded:
+                print("%s was exported in shards last time, and sharded disks have no deltas. Exporting all of it." \
+                      % filename)
+                return filename, None
+            if base is None:
+                print("No earlier export of %s in %s. Exporting all of it." % (filename, C.DIR))
+                return filename, None
+            user = C.src_cluster_admin + "@" + C.src_cluster_ip
+            pwd = "-p" + C.src_cluster_pwd
+            if mycluster.sftp_ls(user, pwd, "/" + C.EXPORTCONTAINER + "/" + filename) == base["bytes"]:
+                return delta, base
+            print("%s in %s is not the one we exported last time. Exporting all of it." % (filename, C.EXPORTCONTAINER))
+            return filename, None
+
+        # Get vdisk information.
+        vdisk_index = get_vdisk_index(mycluster, [d[2]["disk_address"]["vmdisk_uuid"] for d in vm_disk_list])
+        missing = [[d[1], d[2]["disk_address"]["disk_label"]] for d in vm_disk_list \
+                   if d[2]["disk_address"]["vmdisk_uuid"] not in vdisk_index]
+        if len(missing) > 0:
+            print(">>> Vdisk lookup failed. Cannot export these disks: <<<")
+            pprint(missing)
+            sys.exit(1)
+        for vm_uuid, vm_name, vm_disk_dict in vm_disk_list:
+            disk_label = vm_disk_dict["disk_address"]["disk_label"]
+            vmdisk_uuid = vm_disk_dict["disk_address"]["vmdisk_uuid"]
+            # print "FFFF FOUND VM_DISK_UUID", vmdisk_uuid, " ", disk_label
+            
+            vdisk_info = vdisk_index[vmdisk_uuid]
+            # print "VVVVVVVVVVVVV VDISK INFO"
+            # pprint(vdisk_info)
+            l = []
+            # We use the size to convert the largest disks first.
+            size = vdisk_info.get("disk_capacity_in_bytes", vm_disk_dict.get("size", 0))
+            filename, base = export_filename(vm_uuid, disk_label)
+            # Split a vdisk bigger than SHARD_GB into shards, unless we only export a delta.
+            shards = None
+            if not filename.endswith(C.DELTA_SUFFIX):
+                shards = C.shard_ranges(size)
+            if shards is None:
+                parts = [[filename, None]]
+            else:
+                parts = [[C.shard_filename(filename, n), shard] for n, shard in enumerate(shards)]
+                C.save_shard_index(filename, size, [[part] + shard for part, shard in parts])
+                print("*** Splitting %s into %d shards." % (filename, len(parts)))
+            for part, byte_range in parts:
+                l = [vm_uuid, vdisk_info["nutanix_nfsfile_path"], disk_label, vm_name, \
+                     size if byte_range is None else byte_range[1], part, byte_range]
                 nfsfile_list.append(l)
-                print("*** VMDISK_UUID: %s NFS PATH : %s" \
-                      % (vmdisk_uuid, vdisk_info["nutanix_nfsfile_path"]))
+                key = "%s:%s:%s" % (vm_keys[vm_uuid], vmdisk_uuid, size)
+                if byte_range is not None:
+                    key = key + ":%d:%d" % tuple(byte_range)
+                journal.listed("disk", part, key)
+                cache_keys[part] = C.cache_key(vmdisk_uuid, vm_keys[vm_uuid], size)
+                disk = {
+                    "filename": part,
+                    "disk_label": disk_label,
+                    "vmdisk_uuid": vmdisk_uuid,
+                    "size": size
+                }
+                if filename.endswith(C.DELTA_SUFFIX):
+                    disk["delta_of"] = C.delta_base(filename)
+                    disk["base"] = base
+                if byte_range is not None:
+                    cache_keys[part]["range"] = byte_range
+                    disk["shard_of"] = filename
+                    disk["offset"], disk["length"] = byte_range
+                manifest_vms[vm_uuid]["disks"].append(disk)
+            print("*** VMDISK_UUID: %s NFS PATH : %s" \
+                  % (vmdisk_uuid, vdisk_info["nutanix_nfsfile_path"]))
 
         # At this point, all the vdisks we want to process and download are in nfsfile_list.
+        # Download the qcow2 files, args.streams of them at a time, or as many as the removeable drive
+        # and the network keep up with. There is no point swamping a slow HDD with parallel writes.
+        vm_name_byfile = {}
+        for l in nfsfile_list:
+            vm_name = l[3]
+            filename = l[5]
+            vm_name_byfile[filename] = vm_name
+
+        print("STARTING SFTP DOWNLOAD")
+        streams, limit = C.transfer_limit(args.streams, "write")
+        downloads = download_pipeline(len(vm_name_byfile), streams, limit)
+        failed_conversions = []
         # Get a list of our CVMs and distribute tasks amongst them.
         if args.qemu:
             cvm_ip_list = mycluster.get_cvms()
+            jobs = C.conversion_jobs(mycluster,C.src_cvm_pwd)
             
-            i = 0
-            j = 0
-            while i < len(nfsfile_list):
-                l = nfsfile_list[i]
-                vm_uuid = l[0]
+            cache = None
+            if C.CONVERSION_CACHE == True and C.REMOVE_AFTER_DOWNLOAD == False:
+                cache = C.conversion_cache(mycluster, C.EXPORTCONTAINER)
+
+            # Hand the disks to the CVMs, biggest first. Disks an earlier run converted, and disks
+            # whose qcow2 file in EXPORTCONTAINER is still what they would be converted into, go
+            # straight to the downloads.
+            work = []
+            for l in nfsfile_list:
                 nfs_path = l[1]
-                disk_label = l[2]
-                spawned = False
-                print("Entering loop: i %s. j %s VM_UUID: %s. NFS PATH: %s. disk_label: %s" \
-                      % (i, j, vm_uuid, nfs_path, disk_label))
-                cvm_ip = cvm_ip_list[j]
-            
-                # Spawn off first file on CVM1, second on CVM2, etc
-                # If the number of jobs on CVM <= C.MAX_CVM_JOBS, then spawn off a new job.
-                numjobs = mycluster.check_jobs(cvm_ip,C.src_cvm_pwd)
-                if numjobs <= C.MAX_CVM_JOBS:
-                    print("*********")
-                    print("Submitting: %s on %s for conversion. Index: %d" % (nfs_path, cvm_ip, i))
-                    filename = vm_uuid + "_" + disk_label + ".qcow2"
-                    mycluster.ssh_cmd(cvm_ip,C.src_cvm_pwd,filename,nfs_path)
-                
-                    # Sleep for a few seconds to give ssh a chance to fire up before we check.
-                    time.sleep(5)
-                    spawned = True
-                    
-                # If we are here, then we either spawned off a job, or skipped
-                # because we reached C.MAX_CVM_JOBS. Either way, move to the next CVM.
-                j += 1
-                if j == len(cvm_ip_list):
-                    j = 0
-                # If we were able to spawn off a job, then move on to the next nfs file.
-                if spawned == True:
-                    i += 1
-            
-            # End while loop.
-            # Qemu-img jobs are now running on all CVMs. Loop here and keep checking that they
-            # are complete.
-            runtime = 0
-            while True:
-                total_jobs = 0
-                for cvm_ip in cvm_ip_list:
-                    # print "CVM_IP: ", cvm_ip
-                    total_jobs += mycluster.check_jobs(cvm_ip,C.src_cvm_pwd)
-                if total_jobs > 0:
-                    print("%s conversion jobs are still running. Sleeping...(%s seconds)" \
-                          % (total_jobs, runtime))
-                    time.sleep(5)
-                    runtime += 5
+                size = l[4]
+                filename = l[5]
+                byte_range = l[6]
+                if journal.reached("disk", filename, "converted"):
+                    print("%s was converted by an earlier run." % filename)
+                    downloads.add(filename, vm_name_byfile[filename])
+                    continue
+                if cache is not None and not filename.endswith(C.DELTA_SUFFIX):
+                    record = cache.lookup(filename, cache_keys[filename])
+                    if record is not None:
+                        print("%s in %s is up to date. Not converting it again." % (filename, C.EXPORTCONTAINER))
+                        journal.done("disk", filename, "converted")
+                        downloads.add(filename, vm_name_byfile[filename])
+                        continue
+                if byte_range is None:
+                    work.append([filename, nfs_path, size])
                 else:
-                    break
-            # End while loop.
+                    work.append([filename, nfs_path, size, byte_range])
+
+            # Make room in EXPORTCONTAINER for what we convert, as if nothing was thin. Leave the
+            # files of this export alone, and the files our deltas are based on.
+            if cache is not None:
+                keep = set(vm_name_byfile.keys())
+                keep.update([C.delta_base(f) for f in vm_name_byfile if f.endswith(C.DELTA_SUFFIX)])
+                cache.make_room(sum([w[2] for w in work]), C.container_free_bytes(export_container), keep)
+
+            # Start downloading each file as soon as it is converted. No point downloading what
+            # qemu-img didn't finish writing.
+            def download_converted(job):
+                if job["status"] == "done":
+                    journal.done("disk", job["filename"], "converted")
+                    # A delta isn't cached.
+                    if cache is not None and not job["filename"].endswith(C.DELTA_SUFFIX):
+                        cache.store(job["filename"], cache_keys[job["filename"]])
+                    downloads.add(job["filename"], vm_name_byfile[job["filename"]])
+
+            # Don't start another conversion if that would leave more than MAX_PENDING_DOWNLOADS
+            # files waiting for a download.
+            def room_to_convert():
+                return downloads.pending() + jobs.running() < max(1, C.MAX_PENDING_DOWNLOADS)
+
+            jobs.run_all(cvm_ip_list, work, download_converted, room_to_convert)
+            failed_conversions = jobs.report_failures()
+            mycluster.close_ssh()
+        # Without --qemu the qcow2 files are already in EXPORTCONTAINER.
+        else:
+            for filename, vm_name in vm_name_byfile.items():
+                downloads.add(filename, vm_name)
         # End if args.qemu
-        # Download all files at once. We could spawn off multiple download jobs for efficiency.
-        # If we did that however we'd need to make sure the removeable drive wasn't swamped etc.
-        # Without knowing whether the removeable is Flash or HDD, this becomes tricky.
-        i = 0
-        while i < len(nfsfile_list):
-            l = nfsfile_list[i]
-            vm_uuid = l[0]
-            nfs_path = l[1]
-            disk_label = l[2]
-            vm_name = l[3]
-            
-            filename = vm_uuid + "_" + disk_label + ".qcow2"
-            
-            print("STARTING SFTP DOWNLOAD")
-            sftp_download(filename, vm_name)
-            i += 1
+
+        failed = downloads.finish()
+        write_manifest(manifest_vms, failed + failed_conversions)
+        if len(failed) > 0:
+            print(">>> Could not download: <<<")
+            pprint(failed)
+            sys.exit(1)
+        if len(failed_conversions) > 0:
+            print(">>> Could not convert: <<<")
+            pprint(failed_conversions)
+            sys.exit(1)
         
         print("=")
         print("*COMPLETE*")
@@ -15,6 +15,7 @@ import sys
 import json
 import time
 import uuid
+import queue
 import argparse
 import requests
 import threading
@@ -30,110 +31,315 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 # 1. Get file size of srcfile prior to transfer.
 # 2. Construct list to pass to subprocess.Popen().
 # 3. Start sftp in a thread. Its a thread so we can display upload information. (X % in Y seconds etc)
-# 4. Sleep until complete, printing out progress every 5 seconds.
-def sftp_upload(filename, vm_name):
+#    If part of the file is already in SFTPCONTAINER, resume with reput.
+# 4. Sleep until complete, printing out progress every 5 seconds. We count the bytes ourselves, and
+#    only ask the sftp server about the file when the transfer is over.
+# 5. With CHECKSUMS, the file is checksummed as sftp reads it. Check that against the checksum the
+#    export saved, and against the file in SFTPCONTAINER.
+# 6. Return True if the whole file made it to SFTPCONTAINER, False otherwise. Note it down in the
+#    journal, so we don't upload it again if we are run again.
+# srcfilepath is where we upload filename from, if it isn't in DIR.
+def sftp_upload(filename, vm_name, srcfilepath=None):
 
     user = C.dst_cluster_admin + "@" + C.dst_cluster_ip
     pwd = "-p" + C.dst_cluster_pwd
+    result = []
+    # The sftp processes we started, so we can follow how far along they are.
+    procs = []
+
+    # Return the size of dstfilepath in SFTPCONTAINER, 0 if it isn't there yet, or -1 if we can't tell.
+    def remote_size(dstfilepath):
+        for error_count in range(1, C.TRANSFER_RETRIES + 1):
+            dstfilesize = mycluster.sftp_ls(user,pwd,dstfilepath)
+            if dstfilesize >= 0:
+                return dstfilesize
+            elif dstfilesize == -1:
+                return 0
+            print("Sftp_ls: Error %d..sleeping and trying again. %d." % (dstfilesize, error_count))
+            time.sleep(C.backoff(error_count))
+        return -1
 
     def run_sftp(srcfilepath,dstfilepath):
 
-        put_str = "put " + srcfilepath + " " + dstfilepath + "\nchmod 644 " + dstfilepath + "\n\n"
-        # print("User: %s Put_str: %s FileSize: %s" % (user,put_str,srcfilesize))
-        try:
-            # If we don't turn off StrictHostKeyChecking, sftp fails with Host key verification error.
-            # We need the while True loop because every now and then we get Permission denied errors
-            # from the sftp server.
-            error_count=0
-            while True:
-                if C.large_file_opt == True:
-                    cmd_lst = ['sshpass', pwd, 'sftp', '-B', '131072', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
-                else:
-                    cmd_lst = ['sshpass', pwd, 'sftp', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
+        # If we don't turn off StrictHostKeyChecking, sftp fails with Host key verification error.
+        if C.large_file_opt == True:
+            cmd_lst = ['sshpass', pwd, 'sftp', '-B', '131072', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
+        else:
+            cmd_lst = ['sshpass', pwd, 'sftp', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
+
+        # Only carry on with a file that an upload of this version of filename left in SFTPCONTAINER,
+        # in this run or an earlier one. Anything else by that name starts over.
+        fresh = not journal.reached("disk", filename, "transferring")
+        journal.done("disk", filename, "transferring")
+
+        # We need the retry loop because every now and then we get Permission denied errors
+        # from the sftp server, and large files sometimes error out part way through.
+        # Every retry picks up from where the last one stopped.
+        attempt=0
+        while True:
+            offset = remote_size(dstfilepath)
+            rm_str = ""
+            if offset > 0 and fresh:
+                print("%s is not from an upload of this file. Starting over." % dstfilepath)
+                rm_str = "rm " + dstfilepath + "\n"
+                offset = 0
+            # Only resume if what is already in the container matches our copy.
+            elif offset > 0 and C.RESUME_TRANSFERS == True:
+                if offset > srcfilesize or not mycluster.sftp_tail_matches(dstfilepath,srcfilepath,offset):
+                    print("%s does not match %s. Starting over." % (dstfilepath, srcfilepath))
+                    rm_str = "rm " + dstfilepath + "\n"
+                    offset = 0
+            if offset == srcfilesize and offset > 0:
+                progress.finish(offset, True)
+                result.append(True)
+                return
+            progress.offset = max(offset, 0)
+            if offset > 0 and C.RESUME_TRANSFERS == True:
+                put_str = "reput " + srcfilepath + " " + dstfilepath + "\nchmod 644 " + dstfilepath + "\n\n"
+                print("Resuming upload of %s at byte %d." % (srcfilepath, offset))
+            else:
+                put_str = rm_str + "put " + srcfilepath + " " + dstfilepath + "\nchmod 644 " + dstfilepath + "\n\n"
+            fresh = False
+            # print("User: %s Put_str: %s FileSize: %s" % (user,put_str,srcfilesize))
+
+            try:
                 sp = subprocess.Popen(cmd_lst, text=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
                                       stderr=subprocess.PIPE)
-                out,err = sp.communicate(input=put_str)
-                
+                procs.append(sp)
+                # Keep the upload under the bandwidth limit, by how far sftp has read srcfilepath.
+                C.bandwidth.add(sp.pid, lambda: C.file_position(sp.pid, srcfilepath), \
+                                offset if put_str.startswith("reput") else 0)
+                try:
+                    out,err = sp.communicate(input=put_str)
+                finally:
+                    C.bandwidth.remove(sp.pid)
                 print("Popen out from sftp: ", out)
                 print("Popen err: ", err)
-                
-                perms_regex = "Permission denied"
-                searchObj = re.search(perms_regex,err)
-                if searchObj:
-                    if error_count == 3:
-                        print(">>> Giving up after %d attempts. <<<" % error_count)
-                        sys.exit(1)
-                    error_count = error_count + 1
-                    print("Sftp pipe: Permission denied..sleeping and trying again. %d." % error_count)
-                    time.sleep(5)
-                else:
-                    break
-        except Exception as ex:
-            print("Subprocess failed while uploading %s." % srcfilepath)
-            print(ex)
-            sys.exit(1)
-        return
+            except Exception as ex:
+                print("Subprocess failed while uploading %s." % srcfilepath)
+                print(ex)
+
+            # This is the one time we ask the sftp server how much of the file it has.
+            dstfilesize = remote_size(dstfilepath)
+            if dstfilesize == srcfilesize:
+                progress.finish(dstfilesize, True)
+                result.append(True)
+                return
+
+            attempt = attempt + 1
+            if attempt > C.TRANSFER_RETRIES:
+                print(">>> Giving up on %s after %d attempts. <<<" % (srcfilepath, attempt))
+                progress.finish(max(dstfilesize, 0), False)
+                result.append(False)
+                return
+            print("Sftp pipe: %s stopped at byte %d of %d..sleeping %d seconds and trying again. %d." \
+                  % (srcfilepath, dstfilesize, srcfilesize, C.backoff(attempt), attempt))
+            time.sleep(C.backoff(attempt))
     
-    srcfilepath = C.DIR + "/" + filename
+    if srcfilepath is None:
+        srcfilepath = C.DIR + "/" + filename
     dstfilepath = "/" + C.SFTPCONTAINER + "/" + filename
     srcfilesize = os.stat(srcfilepath).st_size
 
     print ("Starting upload..hang on..")
-    start_time = round(time.time())
+    progress = C.transfer_progress(srcfilepath, vm_name, srcfilesize)
+    if C.CHECKSUMS == True:
+        progress.checksum = C.stream_checksum(srcfilepath)
     t=threading.Thread(target=run_sftp,args=(srcfilepath,dstfilepath))
     t.start()
-    time.sleep(1)
     
+    # Count the bytes sftp has read from srcfilepath so far, instead of logging into the sftp
+    # server every 5 seconds to ask how big the file is there.
     while t.is_alive():
-        error_count=0
-        while True:
-            dstfilesize = mycluster.sftp_ls(user,pwd,dstfilepath)
-            # If sftp_ls returned zero or greater break, otherwise deal.
-            if dstfilesize >= 0:
-                break
-            # Maybe the upload didn't start yet?
-            elif dstfilesize == -1:
-                error_count = error_count + 1
-                print("Sftp_ls Could not stat %s..sleeping and trying again. %d." %(dstfilepath,error_count))
-                time.sleep(5)
-            # The sftp server denies permission if its overwhelmed. Sleep and try again.
-            elif dstfilesize == -2:
-                error_count = error_count + 1
-                print("Sftp_ls: Permission denied..sleeping and trying again. %d." % error_count)
-                time.sleep(5)
-            # Some other weird error from sftp. Increase error count so we can sleep and try again..
-            else:
-                error_count = error_count + 1
-                print("Sftp_ls: Unknown error from sftp_ls..sleeping and trying again. %d." % error_count)
-                time.sleep(5)
-            if error_count == 5:
-                print("Check from the command line if upload is progressing..")
-                print(">>> Sftp_ls failure after %d attempts. <<<" % error_count)
-                time.sleep(5)
-        
-        cur_time = round(time.time())
-        runtime = cur_time - start_time
-        print(srcfilepath, "for", vm_name, "uploaded: %0.2f%%. Run time: %d seconds." \
-              %(((dstfilesize / srcfilesize) * 100), runtime))
-        time.sleep(5)
+        t.join(5)
+        if len(procs) > 0 and progress.status == "running":
+            position = C.file_position(procs[-1].pid, srcfilepath)
+            if position is not None:
+                progress.update(position)
+        progress.show("uploaded")
+
+    if len(result) == 0 or not result[0]:
+        return False
+    journal.done("disk", filename, "transferred")
+    if progress.checksum is not None:
+        checksum = progress.checksum.result(srcfilesize)
+        exported = C.load_checksum(filename)
+        if exported is None:
+            print("No checksum from the export for %s." % srcfilepath)
+        elif exported["sha256"] != checksum["sha256"]:
+            print(">>> %s is not what was exported. sha256 now: %s, at export: %s. <<<" \
+                  % (srcfilepath, checksum["sha256"], exported["sha256"]))
+            return False
+        if mycluster.verify_checksum(dstfilepath, checksum) == False:
+            print(">>> Removing %s so it is uploaded again next time. <<<" % dstfilepath)
+            sftp_remove(filename)
+            return False
+        journal.done("disk", filename, "verified")
+    return True
 
-    return
+# Return where to upload filename from. If the export put it in the chunk store (DEDUP_STORE), put
+# it back together in STAGING_DIR first. If it compressed it (LOCAL_COMPRESS), decompress it into
+# STAGING_DIR, on all our cores. Return None if we can't.
+def stage_upload(filename):
+
+    srcfilepath = C.DIR + "/" + filename
+    if os.path.exists(srcfilepath):
+        return srcfilepath
+    dstfilepath = C.STAGING_DIR + "/" + filename
+    start_time = time.time()
+    try:
+        os.makedirs(C.STAGING_DIR, exist_ok=True)
+        if os.path.exists(srcfilepath + C.RECIPE_SUFFIX):
+            size = C.get_chunk_store().rebuild(srcfilepath + C.RECIPE_SUFFIX, dstfilepath)
+        elif os.path.exists(srcfilepath + C.ZBLK_SUFFIX):
+            size = C.zblk_decompress(srcfilepath + C.ZBLK_SUFFIX, dstfilepath)
+        else:
+            return srcfilepath
+    except Exception as ex:
+        print("Could not put %s together in %s." % (filename, C.STAGING_DIR))
+        print(ex)
+        return None
+    runtime = max(time.time() - start_time, 1)
+    print("Staged %s in %d seconds. %0.2f MB/s." % (filename, runtime, size / runtime / 1048576))
+    return dstfilepath
+
+# Remove filename from SFTPCONTAINER.
+def sftp_remove(filename):
+
+    user = C.dst_cluster_admin + "@" + C.dst_cluster_ip
+    pwd = "-p" + C.dst_cluster_pwd
+    cmd_lst = ['sshpass', pwd, 'sftp', '-P', '2222', '-o', 'StrictHostKeyChecking=no', user]
+    rm_str = "rm /" + C.SFTPCONTAINER + "/" + filename + "\n"
+    try:
+        sp = subprocess.Popen(cmd_lst, text=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
+                              stderr=subprocess.PIPE)
+        out,err = sp.communicate(input=rm_str)
+    except Exception as ex:
+        print("Could not remove %s from %s." % (filename, C.SFTPCONTAINER))
+        print(ex)
     
-# Return a dictionary with all vdisks in our storage container.
+# Return a list with all vdisks in our storage container. We get them a page at a time.
 def get_vdisks(mycluster,storage_container_uuid):
     
     cluster_url = mycluster.base_urlv2 + "/storage_containers/" + storage_container_uuid + "/vdisks"
     print("Getting vdisk info")
-    server_response = mycluster.sessionv2.get(cluster_url)
-    print("Response code: %s" % server_response.status_code)
-    return server_response.status_code ,json.loads(server_response.text)
+    status, all_vdisks = mycluster.get_paged(cluster_url)
+    print("Response code: %s" % status)
+    return status, all_vdisks
+
+# The vdisks in SFTPCONTAINER, indexed by the <vm_uuid>_ prefix of their names. We list the
+# container once at the start instead of once per VM. The raw files we convert after that are added
+# as each one is done, since creating a VM only needs their names. See create_vm().
+class container_index():
+    def __init__(self, mycluster, storage_container_uuid):
+
+        self.mycluster = mycluster
+        self.storage_container_uuid = storage_container_uuid
+        self.lock = threading.Lock()
+        self.by_vm = {}
+        self.names = []
+        self.refresh()
+
+    def refresh(self):
+
+        status, all_vdisks = get_vdisks(self.mycluster, self.storage_container_uuid)
+        by_vm = {}
+        for vdisk in all_vdisks:
+            vm_uuid = vdisk["nfs_file_name"].split("_")[0]
+            by_vm.setdefault(vm_uuid, []).append(vdisk)
+        with self.lock:
+            self.by_vm = by_vm
+            self.names = [vdisk["nfs_file_name"] for vdisk in all_vdisks]
+
+    # filename is in SFTPCONTAINER now.
+    def add(self, filename):
+
+        vm_uuid = filename.split("_")[0]
+        with self.lock:
+            if filename in [vdisk["nfs_file_name"] for vdisk in self.by_vm.get(vm_uuid, [])]:
+                return
+            self.by_vm.setdefault(vm_uuid, []).append({"nfs_file_name": filename})
+            self.names.append(filename)
+
+    # Return the vdisks of vm_uuid in SFTPCONTAINER.
+    def vdisks(self, vm_uuid):
+
+        with self.lock:
+            return list(self.by_vm.get(vm_uuid, []))
+
+# Read the VM config file, point it at the new storage container and network, create the VM
+# from its converted disks and power it on. Return True if the VM was created.
+# index is the container_index of SFTPCONTAINER. If an earlier run created the VM, only power it on.
+def import_vm(vm_config_file, storage_container_uuid, network_uuid, index):
+
+    src_uuid = vm_config_file[:-len(".cfg")]
+
+    # Power on the VM we created, and note it down once it is on. Return True if it is.
+    def power_on(vm_uuid):
+        status,resp = mycluster.power_on_vm(vm_uuid)
+        print("Status code for power on: %s" % status)
+        pprint(resp)
+        if status not in [200, 201]:
+            print(">>> Could not power on %s. <<<" % vm_uuid)
+            return False
+        # Powering on is a task of its own, which can still fail.
+        if "task_uuid" in resp:
+            task_status = mycluster.wait_for_task(resp["task_uuid"])
+            if task_status != "Succeeded":
+                print(">>> Could not power on %s: %s. <<<" % (vm_uuid, task_status))
+                return False
+        journal.done("vm", src_uuid, "powered_on")
+        return True
+
+    step, vm_uuid = journal.get("vm", src_uuid)
+    if step == "powered_on":
+        print("%s was created and powered on by an earlier run." % vm_config_file)
+        return True
+    if step == "created":
+        print("%s was created by an earlier run as %s. Powering it on." % (vm_config_file, vm_uuid))
+        return power_on(vm_uuid)
+
+    vmcfg_fp = open(C.DIR + "/" + vm_config_file, "r")
+    vm_json = vmcfg_fp.read()
+    vmcfg_fp.close()
+    
+    # Replace storage_container_uuid in vm_json.
+    # We're looking for a string that looks like:
+    # "storage_container_uuid": "1ed37398-5fb3-49bb-835b-cc9449e0c057"
+    regex_src  = "\"storage_container_uuid\": \"([0-9a-z-]*)\""
+    regex_repl = "\"storage_container_uuid\": \"" + storage_container_uuid + "\""
+    vm_json = re.sub(regex_src, regex_repl, vm_json)
     
+    # Replace network_uuid in vm_json.
+    # We're looking for a string that looks like:
+    # "network_uuid": "4ea3b863-8a9d-43c4-9801-796425569202"
+    regex_src  = "\"network_uuid\": \"([0-9a-z-]*)\""
+    regex_repl = "\"network_uuid\": \"" + network_uuid + "\""
+    vm_json = re.sub(regex_src, regex_repl, vm_json)
+
+    # Get list of vdisks of this VM on SFTPCONTAINER. These should have the qcow2 files
+    # AND the ones in raw format because we converted them earlier.
+    vm_vdisks = index.vdisks(src_uuid)
+    # pprint(vm_vdisks)
+    
+    # Create the VM.
+    status,resp,vm_uuid = create_vm(mycluster,vm_json,vm_vdisks,storage_container_uuid)
+    print ("XXXXXX CREATE VM STATUS: %s." % status)
+    # Check if we returned properly, otherwise give up on this VM.
+    if (status != 201):
+        print ("Could not create VM in %s" % vm_json)
+        pprint(resp)
+        return False
+    journal.done("vm", src_uuid, "created", vm_uuid)
+    
+    return power_on(vm_uuid)
+
 # Take the VM JSON info we have and create a VM with it.
 # Things that change in the new VM:
 # 1. New storage container UUID. This was replaced in __main__
 # 2. New network UUID. This was replaced in __main__
 # 3. Get vm_disk_id corresponding to the VM's disks (which have been uploaded to SFTPCONTAINER)
-#    from all_vdisks
+#    from all_vdisks, which only needs to hold the vdisks of this VM. See container_index.
 # 4. Blank out stuff like MAC and VM UUID, let the system pick this.
 # 5. Adding a suffix during testing. Suffix should be an empty string during production.
 def create_vm(mycluster,vm_json, all_vdisks, storage_container_uuid):
@@ -227,7 +433,7 @@ def create_vm(mycluster,vm_json, all_vdisks, storage_container_uuid):
     # pprint(vm_dict)
     if (len(vm_dict["boot"]["disk_address"]) == 0):
         print(">>> Could not find boot device at: %s:%s" % (C.BOOT_DEVICE_BUS,C.BOOT_DEVICE_INDEX))
-        sys.exit(1)
+        return -1,vm_dict,None
     # pprint(vm_disks)
     vm_dict["vm_disks"] = vm_disks
                 
@@ -288,10 +494,13 @@ if __name__ == "__main__":
     try:
         parser = argparse.ArgumentParser()
         parser.add_argument("--upload", action='store_true', help="Upload vdisks. (default is no, we assume they are already there)")
+        parser.add_argument("--streams", type=int, default=None, \
+                            help="Number of files to upload at the same time. (default is to adapt to the drive and network, see ADAPTIVE_TRANSFERS)")
         parser.add_argument("csvfile", type=str, help="CSV File with VM names")
         args = parser.parse_args()
 
         csvfile = args.csvfile
+        C.bandwidth.start()
         
         requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
         mycluster = C.my_api(C.dst_cluster_ip,C.dst_cluster_admin,C.dst_cluster_pwd)
@@ -301,6 +510,14 @@ if __name__ == "__main__":
             print("Cannot connect to %s" % cluster)
             print("Did you remember to update the config file?")
             sys.exit(1)
+
+        # How far each disk and VM got in earlier runs. See C.run_journal.
+        try:
+            journal = C.run_journal("import", C.IMPORT_STEPS)
+        except Exception as ex:
+            print("Cannot write to", C.DIR, ex)
+            print("Did you remember to update the config file?")
+            sys.exit(1)
         
         # Displays cluster authentication response and information.
         # print("Status code: %s" % status)
@@ -357,58 +574,86 @@ if __name__ == "__main__":
         # Get list of VMs that actually matter.
         important_vms = mycluster.get_important_vms(csvfile)
         
-        # Read config files from C.DIR so we can match VM names and UUIDs.
+        # Read the manifest the export left in C.DIR so we can match VM names and UUIDs. The config
+        # files themselves are only read when each VM is created.
         # Keying by UUID means we can accomodate VMs with the same name (by diff UUIDs obviously)
         vmname_byuuid = {}
-        files = os.listdir(C.DIR)
-        vmname_byuuid = mycluster.get_vmnameanduuid(files)
+        # Size of every qcow2 file in C.DIR, if the manifest tells us.
+        disk_bytes = {}
+        # Size of the vdisk each qcow2 file came from.
+        vdisk_size = {}
+        # The qcow2 file each delta was made from. See C.DELTA_SUFFIX.
+        base_of = {}
+        manifest = C.load_manifest()
+        if manifest is not None:
+            files = []
+            for vm_uuid, vm in manifest["vms"].items():
+                vmname_byuuid[vm_uuid] = vm["name"]
+                files.append(vm["cfg"])
+                for disk in vm["disks"]:
+                    if disk.get("bytes") is not None:
+                        files.append(disk["filename"])
+                        disk_bytes[disk["filename"]] = disk["bytes"]
+                        vdisk_size[disk["filename"]] = disk.get("size")
+                    if disk.get("base") is not None:
+                        base_of[disk["filename"]] = disk["base"]
+        else:
+            # Exports from before we had a manifest. Read every config file in C.DIR.
+            print("No %s in %s. Reading the config files instead." % (C.MANIFEST, C.DIR))
+            # Compressed qcow2 files (LOCAL_COMPRESS) and recipes (DEDUP_STORE) go by the name of the
+            # qcow2 file.
+            suffix_regex = "(" + re.escape(C.ZBLK_SUFFIX) + "|" + re.escape(C.RECIPE_SUFFIX) + ")$"
+            files = sorted(set([re.sub(suffix_regex, "", f) for f in os.listdir(C.DIR)]))
+            vmname_byuuid = mycluster.get_vmnameanduuid(files)
         print("VMNAME_BYUUID")
         pprint(vmname_byuuid)
         
         uuid_regex = "[a-z0-9-]+"
-        # If we choose to, process files, and upload the right qcow2 files.
-        if args.upload:
-            disk_image_regex = "^(" + uuid_regex + ")_(\S+)\.(\d+).qcow2"
-            for f in files:
-                matchObj = re.match(disk_image_regex,f)
-                if matchObj:
-                    vm_uuid = matchObj.group(1)
-                    vm_name = vmname_byuuid[vm_uuid]
-                    if (vm_name not in important_vms):
-                        continue
-                    sftp_upload(f,vm_name)
-                # End if.
-            # End for.
-        # End if upload.
+        # Deltas from an incremental export (C.DELTA_SUFFIX) are disk images too. Converting one
+        # applies it to the disk that was imported last time. So are the shards of a big disk
+        # (C.SHARD_GB). Converting one puts it in its place in the raw disk.
+        disk_image_regex = "^(" + uuid_regex + r")_(\S+)\.(\d+)(\.delta|\.shard\d+)?\.qcow2"
+        # VMs are imported in the order they are listed in the CSV file.
+        def vm_priority(vm_uuid):
+            return important_vms.index(vmname_byuuid[vm_uuid])
 
-        # Now get a list of the disk images/qcow2 files that we uploaded
-        # to SFTPCONTAINER earlier.
+        # If we choose to, upload the right qcow2 files from C.DIR. Otherwise get a list of
+        # the disk images/qcow2 files that were uploaded to SFTPCONTAINER earlier.
         # These should look like vm_uuid_disklabel.qcow2
-        status,resp = get_vdisks(mycluster,storage_container_uuid)
-        all_vdisks = resp["entities"]
-        disk_image_list=[]
-        for vdisk in all_vdisks:
+        index = container_index(mycluster, storage_container_uuid)
+        if args.upload:
+            disk_files = files
+        else:
             # In some AOS versions, nfs_file_name has a .filepart suffix on it if it had been sftp'd
             # to the container. If that is the case, re.search for .filepart, on success, use split()
             # to update nfs_file_name. Three extra lines of code.
-            nfs_file_name = vdisk["nfs_file_name"]
+            disk_files = index.names
+        disk_image_list=[]
+        for f in disk_files:
             # Is it a disk image file?
-            disk_image_regex = "^(" + uuid_regex + ")_(\S+)\.(\d+).qcow2"
-            matchObj = re.match(disk_image_regex,nfs_file_name)
+            matchObj = re.match(disk_image_regex,f)
             if matchObj:
                 # print ("matchobj group(0) %s" % matchObj.group(0))
                 
                 vm_uuid = matchObj.group(1)
+                # Not a VM we exported, or the export didn't get its config file out.
+                if vm_uuid not in vmname_byuuid:
+                    continue
                 vm_name = vmname_byuuid[vm_uuid]
                 # We don't want to process VMs that are not in the CSV file.
                 if (vm_name not in important_vms):
                     continue
-                disk_image_list.append(nfs_file_name)
+                disk_image_list.append(f)
         # End for loop.
         if (len(disk_image_list) == 0):
             print (">>> Cannot proceed. Have you transferred qcow2 files to '%s' on your destination cluster? <<<" % C.SFTPCONTAINER)
             print (">>> You can do this by running this program with the --upload option.")
             sys.exit(1)
+        # A disk with a delta was imported before. Only apply the delta to it, converting the image of
+        # the earlier export again would undo the changes.
+        delta_bases = set([C.delta_base(f) for f in disk_image_list if f.endswith(C.DELTA_SUFFIX)])
+        disk_image_list = [f for f in disk_image_list if f not in delta_bases]
+        disk_image_list.sort(key=lambda f: (vm_priority(re.match(disk_image_regex,f).group(1)), f))
         
         # Now read VM config files from C.DIR.
         # These should look like vm_uuid.cfg.
@@ -436,7 +681,7 @@ if __name__ == "__main__":
             unrecognized_list.append(f)
         
         # End loop where we read files in C.DIR.
-        print("DISK IMAGES in ", C.SFTPCONTAINER)
+        print("DISK IMAGES for", C.SFTPCONTAINER)
         pprint(disk_image_list)
         print("VM CONFIG LIST in ", C.DIR)
         pprint(vm_config_list)
@@ -444,94 +689,274 @@ if __name__ == "__main__":
         pprint(unrecognized_list)
 
         cvm_ip_list = mycluster.get_cvms()
-        
-        # Process disk images.
-        # We assume the files are already transferred, so just ssh into the CVMs
-        # and convert them.
-        i=0
-        j=0
-        while i < len(disk_image_list):
-            spawned = False
-            cvm_ip = cvm_ip_list[j]
-            # Spawn off first file on CVM1, second on CVM2, etc
-            # If the number of jobs on CVM <= C.MAX_CVM_JOBS, then spawn off a new job.
-            numjobs = mycluster.check_jobs(cvm_ip,C.dst_cvm_pwd)
-            if (numjobs <= C.MAX_CVM_JOBS):
-                print("*********")
-                print("Submitting: %s on %s for conversion. Index: %d" % (disk_image_list[i],cvm_ip,i))
-                mycluster.ssh_cmd(cvm_ip,C.dst_cvm_pwd,disk_image_list[i],nfs_path=None)
-
-                # Sleep for a few seconds to give ssh a chance to fire up before we check.
-                time.sleep(5)
-                spawned = True
-            
-            # If we are here, then we either spawned off a job, or skipped
-            # because we reached C.MAX_CVM_JOBS. Either way, move to the next CVM.
-            j += 1
-            if (j == len(cvm_ip_list)):
-                j=0
-            # If we were able to spawn off a job, then move on to the next disk image.
-            if (spawned == True):
-                i += 1
-
-        # End while loop.
-        # Qemu-img jobs are now running on all CVMs. Loop here and keep checking that they 
-        # are complete.
-        runtime=0
-        while True:
-            total_jobs = 0
-            for cvm_ip in cvm_ip_list:
-                # print("CVM_IP: ", cvm_ip)
-                total_jobs += mycluster.check_jobs(cvm_ip,C.dst_cvm_pwd)
-            if total_jobs > 0:
-                print("%s conversion jobs are still running. Sleeping...(%s seconds)" % (total_jobs,runtime))
-                time.sleep(5)
-                runtime += 5
-            else:
-                break
-        # End while loop.
-        
-        # At this point we have converted all files in SFTPCONTAINER.
-        # Start processing each VM config file. 
+
+        # Every VM goes through upload -> convert -> create -> power on by itself. It moves on to
+        # creating the VM as soon as all of its own disks are converted, while the disks of other VMs
+        # are still being uploaded or converted. Uploads run args.streams at a time (or as many as
+        # the drive and network keep up with), conversions as many per CVM as it has room for (see
+        # C.cvm_admission), and VM creates C.MAX_VM_CREATES at a time.
+        # unconverted{} has the disks of each VM that are not through conversion yet.
+        unconverted = {}
         for vm_config_file in vm_config_list:
-            vmcfg_fp = open(C.DIR + "/" + vm_config_file, "r")
-            vm_json = vmcfg_fp.read()
-            vmcfg_fp.close()
-            
-            # Replace storage_container_uuid in vm_json.
-            # We're looking for a string that looks like:
-            # "storage_container_uuid": "1ed37398-5fb3-49bb-835b-cc9449e0c057"
-            regex_src  = "\"storage_container_uuid\": \"([0-9a-z-]*)\""
-            regex_repl = "\"storage_container_uuid\": \"" + storage_container_uuid + "\""
-            vm_json = re.sub(regex_src, regex_repl, vm_json)
-            
-            # Replace network_uuid in vm_json.
-            # We're looking for a string that looks like:
-            # "network_uuid": "4ea3b863-8a9d-43c4-9801-796425569202"
-            regex_src  = "\"network_uuid\": \"([0-9a-z-]*)\""
-            regex_repl = "\"network_uuid\": \"" + network_uuid + "\""
-            vm_json = re.sub(regex_src, regex_repl, vm_json)
-
-            # Get list of vdisks on SFTPCONTAINER. These should have the qcow2 files
-            # AND the ones in raw format because we donverted them earlier.
-            status,resp = get_vdisks(mycluster,storage_container_uuid)
-            all_vdisks = resp["entities"]
-            # pprint(all_vdisks)
-            
-            # Create the VM.
-            status,resp,vm_uuid = create_vm(mycluster,vm_json,all_vdisks,storage_container_uuid)
-            print ("XXXXXX CREATE VM STATUS: %s." % status)
-            # Check if we returned properly, otherwise continue.
-            if (status != 201):
-                print ("Could not create VM in %s" % vm_json)
-                pprint(resp)
+            unconverted[vm_config_file[:-len(".cfg")]] = set()
+        for f in disk_image_list:
+            unconverted.setdefault(re.match(disk_image_regex,f).group(1), set()).add(f)
+        failed_vms = set()
+        failed_creates = []
+        failed_uploads = []
+        # Shards we couldn't convert because their raw disk isn't there, and deltas we won't apply.
+        unconvertible = []
+        pipeline_lock = threading.Lock()
+        create_queue = queue.Queue()
+
+        # Called when a disk is through upload and conversion, or didn't make it. Queue its VM for
+        # creation once it was the last disk of that VM.
+        def disk_finished(f, ok):
+            vm_uuid = re.match(disk_image_regex,f).group(1)
+            with pipeline_lock:
+                if not ok:
+                    failed_vms.add(vm_uuid)
+                unconverted[vm_uuid].discard(f)
+                if len(unconverted[vm_uuid]) > 0:
+                    return
+            if vm_uuid in failed_vms:
+                print (">>> Not creating VM %s. One of its disks could not be uploaded or converted. <<<" % vm_uuid)
+            elif vm_uuid + ".cfg" in vm_config_list:
+                create_queue.put(vm_uuid + ".cfg")
+
+        def create_worker():
+            while True:
+                vm_config_file = create_queue.get()
+                if vm_config_file is None:
+                    return
+                try:
+                    ok = import_vm(vm_config_file, storage_container_uuid, network_uuid, index)
+                except Exception as ex:
+                    print(ex)
+                    ok = False
+                if not ok:
+                    with pipeline_lock:
+                        failed_creates.append(vm_config_file)
+
+        create_threads = []
+        for i in range(max(1, C.MAX_VM_CREATES)):
+            t = threading.Thread(target=create_worker, daemon=True)
+            t.start()
+            create_threads.append(t)
+        # A VM without disks to convert doesn't have to wait for anything.
+        for vm_uuid in list(unconverted.keys()):
+            if len(unconverted[vm_uuid]) == 0 and vm_uuid + ".cfg" in vm_config_list:
+                create_queue.put(vm_uuid + ".cfg")
+
+        # The manifest or the qcow2 files on the removeable drive tell us how big they are. If the
+        # drive isn't mounted, everything is the same size.
+        def disk_work(f):
+            if f in disk_bytes:
+                return [f, None, disk_bytes[f]]
+            try:
+                size = os.stat(C.DIR + "/" + f).st_size
+            except OSError:
+                index = C.zblk_index(C.DIR + "/" + f + C.ZBLK_SUFFIX)
+                size = index["size"] if index is not None else 0
+                size = C.recipe_size(C.DIR + "/" + f + C.RECIPE_SUFFIX) or size
+            return [f, None, size]
+
+        # Which version of each disk and VM this is, for the journal. A disk is the same if it is the
+        # same size and has the same checksum. A VM is the same if its config file and disks are.
+        disk_keys = {}
+        for f in disk_image_list:
+            checksum = C.load_checksum(f)
+            disk_keys[f] = "%d:%s" % (disk_work(f)[2], checksum["sha256"] if checksum is not None else "")
+        # A delta only goes on top of the qcow2 file it was made from. The journal has to show that file
+        # was imported into the raw disk, and that no other delta was applied to it since. Anything
+        # else leaves a corrupt disk.
+        for f in [f for f in disk_image_list if f.endswith(C.DELTA_SUFFIX)]:
+            base = base_of.get(f)
+            applied = journal.key("disk", f)
+            if base is None:
+                reason = "the manifest does not say which export it was made from"
+            elif journal.key("disk", base["filename"]) != "%d:%s" % (base["bytes"], base["sha256"] or "") or \
+                 not journal.reached("disk", base["filename"], "converted"):
+                reason = "%s from the export it was made from was not imported here" % base["filename"]
+            elif applied is not None and applied != disk_keys[f] and journal.reached("disk", f, "converted"):
+                reason = "another delta was applied to the disk since"
+            else:
                 continue
-            
-            # Power on the VM.
-            status,resp = mycluster.power_on_vm(vm_uuid)
-            print("Status code for power on: %s" % status)
-            pprint(resp)
-        # End for loop where we process vm_config files.
+            print(">>> Not applying %s: %s. <<<" % (f, reason))
+            disk_image_list.remove(f)
+            del disk_keys[f]
+            unconvertible.append(f)
+            disk_finished(f, False)
+        for f in disk_image_list:
+            journal.listed("disk", f, disk_keys[f])
+        for vm_config_file in vm_config_list:
+            vm_uuid = vm_config_file[:-len(".cfg")]
+            keys = [disk_keys[f] for f in sorted(disk_keys) if f.startswith(vm_uuid + "_")]
+            journal.listed("vm", vm_uuid, "%d:%s" % (os.path.getmtime(C.DIR + "/" + vm_config_file), \
+                                                       ",".join(keys)))
+        # Disks an earlier run converted are done already.
+        for f in [f for f in disk_image_list if journal.reached("disk", f, "converted")]:
+            print("%s was converted by an earlier run." % f)
+            disk_image_list.remove(f)
+            disk_finished(f, True)
+
+        # Return the work for the conversion scheduler to convert f. The shards of a disk are converted
+        # straight into their place in one raw disk, so create that before the first of them, unless
+        # an earlier run already converted some of them into it. Return None if f can't be converted.
+        raw_disks = set()
+        raw_lock = threading.Lock()
+        def convert_work(f):
+            if re.search(C.SHARD_REGEX, f) is None:
+                return disk_work(f)
+            shard = C.shard_range(f)
+            if shard is None:
+                print(">>> No %s in %s to put %s back in place. <<<" % (C.shard_index_file(f), C.DIR, f))
+            else:
+                size, byte_range = shard
+                raw = re.sub(".qcow2$", ".raw", C.shard_of(f))
+                with raw_lock:
+                    if raw not in raw_disks:
+                        converted = [s for s in disk_keys if C.shard_of(s) == C.shard_of(f) and \
+                                     journal.reached("disk", s, "converted")]
+                        if len(converted) > 0 or \
+                           mycluster.create_raw(cvm_ip_list, C.dst_cvm_pwd, C.SFTPCONTAINER, raw, size):
+                            raw_disks.add(raw)
+                if raw in raw_disks:
+                    return disk_work(f) + [byte_range]
+            with pipeline_lock:
+                unconvertible.append(f)
+            disk_finished(f, False)
+            return None
+
+        # A disk is converted once qemu-img is done with it. If the manifest tells us the size of its
+        # vdisk, also check the raw disk is the size the VM had on the source.
+        def disk_converted(job):
+            ok = job["status"] == "done"
+            # A delta goes into the raw file of the disk it was made from.
+            f = job["filename"]
+            if f.endswith(C.DELTA_SUFFIX):
+                f = C.delta_base(f)
+            raw = re.sub(".qcow2$", ".raw", C.shard_of(f))
+            size = vdisk_size.get(job["filename"])
+            if ok and size is not None:
+                info = mycluster.image_info(job["cvm_ip"], C.dst_cvm_pwd, C.SFTPCONTAINER, raw)
+                if info is None or info["virtual-size"] != size:
+                    print(">>> %s is not the size it was on the source: %s bytes. <<<" % (job["filename"], size))
+                    pprint(info)
+                    ok = False
+                else:
+                    print("%s: %0.2f GB. %0.2f GB on disk." \
+                          % (job["filename"], size / 1073741824, info.get("actual-size", 0) / 1073741824))
+            if ok:
+                index.add(raw)
+                journal.done("disk", job["filename"], "converted")
+            disk_finished(job["filename"], ok)
+
+        # Process disk images. If we upload them, each one goes to the CVMs for conversion as soon
+        # as it is in SFTPCONTAINER. Otherwise they are already there, so just ssh into the CVMs
+        # and convert them, biggest first.
+        jobs = C.conversion_jobs(mycluster,C.dst_cvm_pwd)
+        if args.upload:
+            convert_feed = queue.Queue()
+            # nuploads upload threads. If limit isn't None, it decides how many of them upload at
+            # any time, depending on how fast the drive and the network go.
+            streams, limit = C.transfer_limit(args.streams, "read")
+            nuploads = max(1, min(streams, len(disk_image_list)))
+            # Files that are ready to upload, as [filename, where to upload it from]. Compressed files,
+            # and files from the chunk store, are put back together in STAGING_DIR while the ones
+            # before them upload. We only get one file ahead of each upload thread, so STAGING_DIR
+            # doesn't fill up.
+            staged_queue = queue.Queue(maxsize=nuploads)
+
+            # A file an earlier run uploaded (and checked, with CHECKSUMS) only needs converting.
+            uploaded = "verified" if C.CHECKSUMS == True else "transferred"
+
+            def stage_worker():
+                for f in disk_image_list:
+                    if journal.reached("disk", f, uploaded):
+                        print("%s was uploaded by an earlier run." % f)
+                        w = convert_work(f)
+                        if w is not None:
+                            convert_feed.put(w)
+                        continue
+                    srcfilepath = stage_upload(f)
+                    if srcfilepath is None:
+                        with pipeline_lock:
+                            failed_uploads.append(f)
+                        disk_finished(f, False)
+                        continue
+                    staged_queue.put([f, srcfilepath])
+                for i in range(nuploads):
+                    staged_queue.put(None)
+
+            def upload_worker():
+                while True:
+                    # Wait for our turn before taking a file, so staged files don't pile up.
+                    if limit is not None:
+                        limit.acquire()
+                    l = staged_queue.get()
+                    if l is None:
+                        if limit is not None:
+                            limit.release()
+                        return
+                    f, srcfilepath = l
+                    vm_name = vmname_byuuid[re.match(disk_image_regex,f).group(1)]
+                    try:
+                        ok = sftp_upload(f,vm_name,srcfilepath)
+                    finally:
+                        if limit is not None:
+                            limit.release()
+                    if srcfilepath != C.DIR + "/" + f:
+                        os.remove(srcfilepath)
+                    if ok:
+                        w = convert_work(f)
+                        if w is not None:
+                            convert_feed.put(w)
+                    else:
+                        with pipeline_lock:
+                            failed_uploads.append(f)
+                        disk_finished(f, False)
+
+            # Tell the conversion scheduler nothing else is coming once every upload is done.
+            def upload_all():
+                threading.Thread(target=stage_worker, daemon=True).start()
+                upload_threads = []
+                for i in range(nuploads):
+                    t = threading.Thread(target=upload_worker, daemon=True)
+                    t.start()
+                    upload_threads.append(t)
+                for t in upload_threads:
+                    t.join()
+                if limit is not None:
+                    limit.close()
+                convert_feed.put(None)
+
+            threading.Thread(target=upload_all, daemon=True).start()
+            jobs.run_all(cvm_ip_list, [], disk_converted, None, convert_feed)
+        else:
+            work = [convert_work(f) for f in disk_image_list]
+            jobs.run_all(cvm_ip_list, [w for w in work if w is not None], disk_converted)
+        # End if upload.
+        failed_conversions = jobs.report_failures() + unconvertible
+        mycluster.close_ssh()
+
+        # Every disk is through conversion now. Wait for the last VMs to be created.
+        for t in create_threads:
+            create_queue.put(None)
+        for t in create_threads:
+            t.join()
+
+        if len(failed_uploads) > 0:
+            print(">>> Could not upload: <<<")
+            pprint(failed_uploads)
+        if len(failed_conversions) > 0:
+            print(">>> Could not convert: <<<")
+            pprint(failed_conversions)
+        if len(failed_creates) > 0:
+            print(">>> Could not create or power on VMs in: <<<")
+            pprint(failed_creates)
+        if len(failed_uploads) + len(failed_conversions) + len(failed_creates) > 0:
+            sys.exit(1)
 
         print("================================")
         print("*COMPLETE*")